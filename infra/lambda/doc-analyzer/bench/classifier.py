@@ -0,0 +1,80 @@
+"""
+Micro-benchmark: document classification over 100k synthetic S3 keys.
+
+Compares the memoized first-match DocumentClassifier in handler.py with the
+original classify_document() and checks both agree. Keys repeat
+across passes the way sibling and partner files do across events. Run from
+the doc-analyzer directory:
+
+    python bench/classifier.py [--keys 100000] [--passes 3]
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import handler  # noqa: E402
+
+WORDS = [
+    "Кошторис", "РП СЕС", "Акт", "Договір", "Технічний звіт", "Технічне обстеження",
+    "invoice", "Рахунок", "photo", "scan", "план", "схема", "v2", "final", "PVs",
+]
+TEXT = "Зведений кошторисний розрахунок вартості об'єкта будівництва. " * 20
+
+
+def legacy_classify_document(s3_key: str, text: str) -> str:
+    """classify_document as it was before DocumentClassifier."""
+    filename = s3_key.lower()
+    text_start = text[:1000].lower()
+
+    for pattern, doc_type in handler.CLASSIFICATION_RULES:
+        if pattern in filename or pattern in text_start:
+            return doc_type
+    return "unknown"
+
+
+def synthetic_keys(count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    return [
+        f"partner{rng.randint(1, 20)}/project{rng.randint(1, 400)}/"
+        f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}.{rng.choice(['pdf', 'docx', 'jpg'])}"
+        for i in range(count)
+    ]
+
+
+def timed(fn, keys: list, text: str, passes: int) -> float:
+    started = time.perf_counter()
+    for _ in range(passes):
+        for key in keys:
+            fn(key, text)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--keys", type=int, default=100000)
+    parser.add_argument("--passes", type=int, default=3)
+    args = parser.parse_args()
+
+    keys = synthetic_keys(args.keys)
+    for key in keys:
+        for text in ("", TEXT):
+            if legacy_classify_document(key, text) != handler.classify_document(key, text):
+                sys.exit(f"classification differs for {key!r}")
+
+    handler.CLASSIFIER.classify_filename.cache_clear()
+    for name, text in (("filename only", ""), ("filename + text", TEXT)):
+        legacy_s = timed(legacy_classify_document, keys, text, args.passes)
+        current_s = timed(handler.classify_document, keys, text, args.passes)
+        print(
+            f"{name}: {args.keys} keys x {args.passes} passes | "
+            f"legacy {legacy_s * 1000:.0f} ms, memoized {current_s * 1000:.0f} ms "
+            f"({legacy_s / current_s:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
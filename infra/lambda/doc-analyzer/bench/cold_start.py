@@ -0,0 +1,101 @@
+"""
+Cold-start check: import time of handler.py and the first skipped event.
+
+Runs fresh interpreters with -X importtime, reports the median cumulative
+import time of the handler module with its slowest imports, plus the time
+for a cold process to import the handler and dismiss an _analysis/ event
+(no boto3, fitz or docx should load for that). Exits non-zero when the
+median import exceeds the budget. Run from the doc-analyzer directory:
+
+    python bench/cold_start.py [--runs 7] [--budget-ms 100]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent.parent
+
+SKIP_EVENT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import handler
+handler.handler({"Records": [{"s3": {"bucket": {"name": "b"}, "object": {"key": "_analysis/x.analysis.json"}}}]}, None)
+elapsed = time.perf_counter() - start
+heavy = [m for m in ("boto3", "fitz", "docx", "numpy") if m in sys.modules]
+print(json.dumps({"ms": elapsed * 1000, "loaded": heavy}))
+"""
+
+
+def import_profile() -> tuple:
+    """One fresh run: (handler's cumulative import time, {direct import of
+    handler: cumulative time}), in microseconds."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import handler"],
+        cwd=HERE, capture_output=True, text=True, check=True,
+    )
+    total = 0
+    children = {}
+    pending = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        if not cumulative_us.strip().isdigit():
+            continue
+        # importtime prints children before their parent, indented two
+        # spaces per level below the first
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if name == "handler" and depth == 0:
+            total = int(cumulative_us)
+            children = pending
+        elif depth == 0:
+            pending = {}
+        elif depth == 1:
+            pending[name] = int(cumulative_us)
+    return total, children
+
+
+def skip_event_run() -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", SKIP_EVENT_SCRIPT],
+        cwd=HERE, capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--budget-ms", type=float, default=100.0,
+                        help="maximum median import time of handler.py")
+    args = parser.parse_args()
+
+    profiles = [import_profile() for _ in range(args.runs)]
+    handler_ms = statistics.median(total for total, _ in profiles) / 1000
+    direct = {}
+    for _, children in profiles:
+        for name, us in children.items():
+            direct.setdefault(name, []).append(us)
+    slowest = sorted(((statistics.median(v) / 1000, n) for n, v in direct.items()), reverse=True)[:8]
+
+    skips = [skip_event_run() for _ in range(args.runs)]
+    skip_ms = statistics.median(s["ms"] for s in skips)
+    loaded = sorted({m for s in skips for m in s["loaded"]})
+
+    print(f"handler import: {handler_ms:.1f} ms median over {args.runs} runs (budget {args.budget_ms:.0f} ms)")
+    print("slowest imports made by handler.py:")
+    for ms, name in slowest:
+        print(f"  {name:<28}{ms:>8.1f} ms")
+    print(f"cold import + skipped event: {skip_ms:.1f} ms; heavy modules loaded: {', '.join(loaded) or 'none'}")
+
+    if handler_ms > args.budget_ms:
+        print(f"FAIL: handler import is over budget by {handler_ms - args.budget_ms:.1f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
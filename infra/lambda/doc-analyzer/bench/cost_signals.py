@@ -0,0 +1,118 @@
+"""
+Micro-benchmark: extract_cost_signals on synthetic кошторис text.
+
+Compares the single-sweep scanner in handler.py against the original
+four-pass CURRENCY_PATTERNS implementation and checks both give identical
+output. Run from the doc-analyzer directory:
+
+    python bench/cost_signals.py [--rows 5000] [--repeat 3]
+"""
+import argparse
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import handler  # noqa: E402
+
+
+def legacy_extract_cost_signals(text: str) -> dict:
+    """extract_cost_signals as it was before the single-sweep scanner."""
+    amounts = []
+    for pattern, currency in handler.CURRENCY_PATTERNS:
+        for match in re.finditer(pattern, text):
+            raw = match.group(1).replace(" ", "").replace(",", ".")
+            try:
+                val = float(raw)
+                if val > 100:
+                    amounts.append({
+                        "raw": match.group(0).strip()[:80],
+                        "value": val,
+                        "currency": currency,
+                    })
+            except ValueError:
+                pass
+
+    seen = set()
+    unique = []
+    for a in amounts:
+        key = (a["value"], a["currency"])
+        if key not in seen:
+            seen.add(key)
+            unique.append(a)
+    unique.sort(key=lambda x: x["value"], reverse=True)
+
+    return {
+        "count": len(unique),
+        "amounts": unique[:30],
+        "max_amount": unique[0] if unique else None,
+        "total_uah": sum(a["value"] for a in unique if a["currency"] == "UAH"),
+    }
+
+
+def synthetic_estimate(rows: int, seed: int = 0) -> str:
+    """A flattened AVK-5 style estimate: padded table columns, amounts in
+    several currencies and the odd long run of bare numbers."""
+    rng = random.Random(seed)
+    lines = ["Локальний кошторис на будівельні роботи № 02-01-01", "Складений в поточних цінах станом на 2025 р."]
+    for i in range(rows):
+        qty = rng.randint(1, 500)
+        price = rng.randint(100, 250000) + rng.choice([0, 0.5, 0.25])
+        total = f"{qty * price:,.2f}".replace(",", " ")
+        currency = rng.choice(["грн", "грн", "грн", "грн.", "USD", "EUR", "дол."])
+        lines.append(
+            f"{i + 1:>6}   КБ{rng.randint(10, 99)}-{rng.randint(1, 999)}   Панель сонячна {rng.randint(300, 600)} Вт"
+            f"{' ' * rng.randint(2, 30)}шт{' ' * rng.randint(2, 12)}{qty}{' ' * rng.randint(2, 12)}"
+            f"{price}{' ' * rng.randint(2, 20)}{total} {currency}"
+        )
+        if i % 50 == 0:
+            lines.append("  ".join(str(rng.randint(0, 9999)) for _ in range(60)))
+        if i % 200 == 0:
+            lines.append(f"Разом по розділу: UAH {rng.randint(10000, 9000000)} ,00")
+    return "\n".join(lines)
+
+
+def pathological(length: int) -> str:
+    """Digits and whitespace with no currency marker until the very end."""
+    return ("1 " * (length // 2)) + "\n  " * 10 + "грн"
+
+
+def timed(fn, text: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(text)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    cases = [
+        (f"estimate ({args.rows} rows)", synthetic_estimate(args.rows)),
+        ("whitespace-heavy run (8k chars)", pathological(8000)),
+    ]
+    for name, text in cases:
+        legacy = legacy_extract_cost_signals(text)
+        current = handler.extract_cost_signals(text)
+        # by_currency was added after the rewrite; the legacy code never had it
+        if legacy != {k: v for k, v in current.items() if k != "by_currency"}:
+            sys.exit(f"{name}: output differs from the legacy implementation")
+        legacy_s = timed(legacy_extract_cost_signals, text, args.repeat)
+        current_s = timed(handler.extract_cost_signals, text, args.repeat)
+        print(
+            f"{name}: {len(text) / 1e6:.2f} MB, {current['count']} unique amounts | "
+            f"legacy {legacy_s * 1000:.1f} ms, single-sweep {current_s * 1000:.1f} ms "
+            f"({legacy_s / current_s:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
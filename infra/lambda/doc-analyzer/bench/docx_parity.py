@@ -0,0 +1,195 @@
+"""
+Parity check: the streaming DOCX extractor against python-docx.
+
+Builds random documents with python-docx: paragraphs with line and page
+breaks, tabs and hyperlinks, and tables with horizontal and vertical merges,
+rows shifted by gridBefore, multi-paragraph and nested-table cells. Each one
+goes through extract_docx_xml() in handler.py and through the python-docx
+reading that extract_docx() falls back to; any difference is reported and,
+with --save, the document is kept for debugging. Ends with a timing of both
+on one large merged table. Run from the doc-analyzer directory:
+
+    python bench/docx_parity.py [--docs 1000] [--seed 0] [--save failures/]
+"""
+import argparse
+import copy
+import io
+import random
+import sys
+import time
+from pathlib import Path
+
+import docx
+from docx.enum.text import WD_BREAK
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import handler  # noqa: E402
+
+TEXTS = ["", "  ", "Кошторис 1 234,50 грн", "a\tb", "ФОП Іваненко", "під'їзд", " x "]
+
+
+def python_docx_extract(source: bytes) -> dict:
+    """extract_docx through python-docx, as its fallback path reads it."""
+    doc = docx.Document(io.BytesIO(source))
+    paragraphs = [p.text for p in doc.paragraphs if p.text.strip()]
+    tables = [
+        {"table_index": i, "rows": [[cell.text.strip() for cell in row.cells] for row in table.rows]}
+        for i, table in enumerate(doc.tables)
+    ]
+    return {"paragraphs": paragraphs, "tables": tables, "full_text": "\n".join(paragraphs)}
+
+
+def add_hyperlink(paragraph, text: str):
+    link, run, t = OxmlElement("w:hyperlink"), OxmlElement("w:r"), OxmlElement("w:t")
+    t.text = text
+    run.append(t)
+    link.append(run)
+    paragraph._p.append(link)
+
+
+def shift_row(row, columns: int):
+    """Drop the row's first cells and mark the grid columns they covered as
+    skipped (w:gridBefore), the way rows indented past the table edge are
+    saved."""
+    tr = row._tr
+    dropped = 0
+    for tc in list(tr.tc_lst)[:columns]:
+        if tc.grid_span != 1 or tc.vMerge is not None:
+            break
+        tr.remove(tc)
+        dropped += 1
+    if dropped:
+        tr_pr = tr.get_or_add_trPr()
+        grid_before = OxmlElement("w:gridBefore")
+        grid_before.set(qn("w:val"), str(dropped))
+        tr_pr.insert(0, grid_before)
+
+
+def add_table(doc, rng: random.Random):
+    rows, cols = rng.randint(1, 6), rng.randint(1, 6)
+    table = doc.add_table(rows=rows, cols=cols)
+    for i in range(rows):
+        for j in range(cols):
+            cell = table.cell(i, j)
+            cell.text = f"{i}.{j} {rng.choice(TEXTS)}"
+            if rng.random() < 0.2:
+                cell.add_paragraph(rng.choice(TEXTS))
+    for _ in range(rng.randint(0, 3)):
+        a = (rng.randrange(rows), rng.randrange(cols))
+        b = (rng.randrange(rows), rng.randrange(cols))
+        try:
+            table.cell(*a).merge(table.cell(*b))
+        except Exception:  # merge shape python-docx refuses
+            pass
+    if rng.random() < 0.15:
+        table.cell(0, 0).add_table(2, 2).cell(0, 0).text = "nested"
+    for row in table.rows:
+        if rng.random() < 0.25:
+            shift_row(row, rng.randint(1, 2))
+
+
+def random_document(rng: random.Random) -> bytes:
+    doc = docx.Document()
+    for _ in range(rng.randint(0, 8)):
+        paragraph = doc.add_paragraph(rng.choice(TEXTS))
+        run = paragraph.add_run(rng.choice(["x", "", " y "]))
+        kind = rng.random()
+        if kind < 0.2:
+            run.add_break()
+        elif kind < 0.3:
+            run.add_break(WD_BREAK.PAGE)
+        elif kind < 0.4:
+            add_hyperlink(paragraph, "посилання")
+        if rng.random() < 0.4:
+            add_table(doc, rng)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def outcome(fn, source: bytes):
+    try:
+        return fn(source)
+    except Exception as e:
+        return f"raised {type(e).__name__}"
+
+
+def merge_block(rows: list):
+    """Merge the first two grid columns of consecutive w:tr rows into one
+    cell: w:gridSpan on each row, w:vMerge down the block."""
+    for i, tr in enumerate(rows):
+        first, second = tr.tc_lst[:2]
+        tr.remove(second)
+        props = first.get_or_add_tcPr()
+        span, merge = OxmlElement("w:gridSpan"), OxmlElement("w:vMerge")
+        span.set(qn("w:val"), "2")
+        if i == 0:
+            merge.set(qn("w:val"), "restart")
+        props.append(span)
+        props.append(merge)
+
+
+def large_table(rows: int = 3000, cols: int = 8) -> bytes:
+    """One big table, built by copying row XML (python-docx cell access is
+    quadratic in the table size), with a merged block every third row of
+    the first 300."""
+    doc = docx.Document()
+    table = doc.add_table(rows=1, cols=cols)
+    template = table.rows[0]._tr
+    for cell in table.rows[0].cells:
+        cell.paragraphs[0].add_run("-")
+    trs = [template] + [copy.deepcopy(template) for _ in range(rows - 1)]
+    for i, tr in enumerate(trs):
+        for j, t in enumerate(tr.iter(qn("w:t"))):
+            t.text = f"{i * j} грн"
+        if i:
+            table._tbl.append(tr)
+    for i in range(0, min(rows, 300) - 2, 3):
+        merge_block(trs[i:i + 3])
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--docs", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", type=Path, help="directory to keep mismatching documents in")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    mismatches = 0
+    for i in range(args.docs):
+        source = random_document(rng)
+        expected = outcome(python_docx_extract, source)
+        actual = outcome(handler.extract_docx_xml, source)
+        if actual == expected:
+            continue
+        mismatches += 1
+        if mismatches <= 3:
+            print(f"document {i}:\n  python-docx: {expected}\n  streaming:   {actual}")
+        if args.save:
+            args.save.mkdir(parents=True, exist_ok=True)
+            (args.save / f"mismatch-{args.seed}-{i}.docx").write_bytes(source)
+    print(f"{args.docs} random documents, {mismatches} mismatches")
+
+    source = large_table()
+    started = time.perf_counter()
+    expected = python_docx_extract(source)
+    python_docx_s = time.perf_counter() - started
+    started = time.perf_counter()
+    actual = handler.extract_docx_xml(source)
+    streaming_s = time.perf_counter() - started
+    print(f"3000x8 merged table ({len(source) / 1e6:.2f} MB): python-docx {python_docx_s * 1000:.0f} ms, "
+          f"streaming {streaming_s * 1000:.0f} ms ({python_docx_s / streaming_s:.1f}x), "
+          f"{'same' if actual == expected else 'DIFFERENT'} output")
+    if mismatches or actual != expected:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
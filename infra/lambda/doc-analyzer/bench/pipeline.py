@@ -0,0 +1,248 @@
+"""
+End-to-end benchmark: handler() / analyze_bucket() against a local S3 stand-in.
+
+Seeds a moto-mocked bucket with generated partner folders (кошторис PDFs,
+design PDFs, technical report DOCX, partner PV summaries) of controlled size,
+runs the real pipeline over them and reports docs/s, p50/p95 latency per
+stage and peak RSS. Nothing touches the real bucket. Needs moto
+(pip install moto). Run from the doc-analyzer directory:
+
+    python bench/pipeline.py [--projects 20] [--pages 8] [--rows 40]
+                             [--mode handler|bucket] [--workers 4]
+                             [--s3-io pooled|sync|both] [--latency-ms 20]
+
+--s3-io sync sets S3_IO_WORKERS=0 (every request on the document's thread),
+pooled uses the S3IO prefetch/overlap path, both runs the two back to back
+on fresh buckets for a throughput comparison. moto answers in microseconds,
+so --latency-ms adds a per-request delay to make I/O cost what it does
+against real S3.
+
+Stages are the ones process_document() times with handler.StageTimer,
+per document, so new pipeline stages show up here without changes. Among
+them: download, extract, classify, project_info, cost, cost_table, fx,
+list, verify, duplicates, hit_index, then upload and rollup (sync S3 I/O)
+or io_wait and write (pooled), parts and search_index. --enable turns on
+the optional stages (duplicates: DUPLICATE_INDEX, search: SEARCH_INDEX,
+corpus: CORPUS_EXPORT, which needs pyarrow).
+"""
+import argparse
+import io
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+os.environ.setdefault("RESULT_CACHE", "off")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import boto3  # noqa: E402
+from botocore.config import Config  # noqa: E402
+import fitz  # noqa: E402
+from docx import Document  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+import handler  # noqa: E402
+
+BUCKET = "bench-partner-docs"
+FEATURES = {"duplicates": "DUPLICATE_INDEX", "search": "SEARCH_INDEX", "corpus": "CORPUS_EXPORT"}
+PARTNERS = ["ecoaction", "greencubator", "razom"]
+
+# Built into PyMuPDF and covers Cyrillic, unlike the base-14 fonts
+FONT = fitz.Font("cjk")
+
+
+def make_pdf(pages: int, page_text) -> bytes:
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_font(fontname="F0", fontbuffer=FONT.buffer)
+        page.insert_textbox(fitz.Rect(36, 36, 560, 806), page_text(i), fontname="F0", fontsize=8)
+    doc.subset_fonts()
+    data = doc.tobytes(garbage=3, deflate=True)
+    doc.close()
+    return data
+
+
+def make_docx(paragraphs: list, rows: list) -> bytes:
+    doc = Document()
+    for text in paragraphs:
+        doc.add_paragraph(text)
+    table = doc.add_table(rows=len(rows), cols=len(rows[0]))
+    for r, row in enumerate(rows):
+        for c, value in enumerate(row):
+            table.cell(r, c).text = value
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def estimate_page(project: int, rows: int):
+    def text(i):
+        lines = [
+            "Зведений кошторисний розрахунок (АВК-5)",
+            f"Дніпропетровська обл., м. Самар, школа № {project}",
+            "Потужність СЕС 50 кВт. Співфінансування громади 20%.",
+        ]
+        lines += [f"{j + 1}. Панель сонячна, шт {j + 2}  {1000 * (j + 1) + i} 234,50 грн" for j in range(rows)]
+        lines.append(f"Разом по сторінці {(i + 1) * 125000} грн, {(i + 1) * 3000} USD")
+        return "\n".join(lines)
+    return text
+
+
+def seed_bucket(s3, projects: int, pages: int, rows: int) -> list:
+    """Create the bucket and return the seeded document keys."""
+    s3.create_bucket(Bucket=BUCKET)
+    design = make_pdf(pages, lambda i: "Робочий проект СЕС. Котельня, насосна станція.\nФОП Петренко П.П.\n" * 20)
+    report = make_docx(
+        ["Технічний звіт обстеження даху", "Вартість обстеження 12 500,00 грн"] * 10,
+        [["Назва", "Кількість", "Ціна"]] + [["Панель", str(n), f"{n * 5} 000 грн"] for n in range(1, 30)],
+    )
+    keys = []
+
+    def put(key, body):
+        s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+        keys.append(key)
+
+    for p in range(projects):
+        partner = PARTNERS[p % len(PARTNERS)]
+        base = f"{partner}/project{p:03d}/"
+        put(base + "Кошторис СЕС.pdf", make_pdf(pages, estimate_page(p, rows)))
+        put(base + "РП СЕС.pdf", design)
+        put(base + "Технічний звіт.docx", report)
+        s3.put_object(Bucket=BUCKET, Key=base + "photo.jpg", Body=b"\xff\xd8\xff")
+    for partner in PARTNERS[:projects]:
+        put(f"{partner}/{partner}_PVs.docx",
+            make_docx(["Project verification summary", "ФОП Іваненко І.І.", "співфінансування 20%"], [["a", "b"]]))
+    return keys
+
+
+def add_latency(client, latency_ms: float):
+    """Delay every request the client sends, like a round trip to S3 would."""
+    if latency_ms > 0:
+        client.meta.events.register("before-send.s3", lambda **kwargs: time.sleep(latency_ms / 1000))
+
+
+class StageSamples:
+    """Per-document stage timings from handler.StageTimer itself: METRICS
+    gets "emf" for the run and each document's EMF record is captured here
+    instead of printed, so every stage the handler times is reported under
+    its own name. Search delta uploads happen once per batch, outside any
+    document, and are timed as search_flush."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)  # stage -> ms per document, in first-seen order
+        self.lock = threading.Lock()
+        self.originals = {}
+
+    def add(self, stage: str, ms: float):
+        with self.lock:
+            self.samples[stage].append(ms)
+
+    def record(self, s3_key: str, file_type: str, metrics: dict):
+        for stage, ms in metrics["stages_ms"].items():
+            self.add(stage, ms)
+
+    def install(self):
+        writer = handler.SearchIndexWriter
+        self.originals = {"METRICS": handler.METRICS, "emit_emf": handler.emit_emf, "flush": writer.flush}
+        flush = writer.flush
+
+        def timed_flush(index):
+            start = time.perf_counter()
+            try:
+                return flush(index)
+            finally:
+                self.add("search_flush", (time.perf_counter() - start) * 1000)
+
+        handler.METRICS = handler.METRICS | {"emf"}
+        handler.emit_emf = self.record
+        writer.flush = timed_flush
+
+    def uninstall(self):
+        handler.METRICS = self.originals["METRICS"]
+        handler.emit_emf = self.originals["emit_emf"]
+        handler.SearchIndexWriter.flush = self.originals["flush"]
+
+    def report(self):
+        print(f"{'stage':<14}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'total s':>10}")
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            p50 = statistics.median(samples)
+            p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+            print(f"{stage:<14}{len(samples):>7}{p50:>10.2f}{p95:>10.2f}{sum(samples) / 1000:>10.2f}")
+
+
+def run_handler(keys: list, batch: int):
+    for i in range(0, len(keys), batch):
+        records = [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}} for key in keys[i:i + batch]]
+        handler.handler({"Records": records}, None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--projects", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=8, help="pages per generated PDF")
+    parser.add_argument("--rows", type=int, default=40, help="amount lines per estimate page")
+    parser.add_argument("--mode", choices=("handler", "bucket"), default="handler",
+                        help="S3 events through handler(), or analyze_bucket()")
+    parser.add_argument("--batch", type=int, default=10, help="records per handler event")
+    parser.add_argument("--workers", type=int, default=4, help="analyze_bucket workers")
+    parser.add_argument("--s3-io", choices=("pooled", "sync", "both"), default="pooled",
+                        help="background S3 I/O (S3IO) or every request on the document's thread")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="added delay per S3 request")
+    parser.add_argument("--enable", action="append", default=[], choices=sorted(FEATURES),
+                        help="optional stage to turn on (repeatable)")
+    args = parser.parse_args()
+    for feature in args.enable:
+        setattr(handler, FEATURES[feature], True)
+
+    io_modes = ("sync", "pooled") if args.s3_io == "both" else (args.s3_io,)
+    throughput = {}
+    for io_mode in io_modes:
+        throughput[io_mode] = run(args, io_mode)
+    if len(throughput) > 1:
+        print(f"pooled vs sync S3 I/O: {throughput['pooled'] / throughput['sync']:.2f}x docs/s")
+
+
+def run(args, io_mode: str) -> float:
+    """Seed a fresh bucket, run the pipeline over it and report; returns docs/s."""
+    io_workers = handler.S3_IO_WORKERS
+    handler.S3_IO_WORKERS = 0 if io_mode == "sync" else io_workers or 16
+    with mock_aws():
+        handler.s3 = boto3.client("s3", config=Config(max_pool_connections=handler.S3_MAX_POOL_CONNECTIONS))
+        handler.SOURCE_BUCKET = handler.RESULTS_BUCKET = BUCKET
+
+        started = time.perf_counter()
+        keys = seed_bucket(handler.s3, args.projects, args.pages, args.rows)
+        print(f"Seeded {len(keys)} documents in {time.perf_counter() - started:.1f}s")
+        add_latency(handler.s3, args.latency_ms)
+
+        timer = StageSamples()
+        timer.install()
+        started = time.perf_counter()
+        try:
+            if args.mode == "handler":
+                run_handler(keys, args.batch)
+            else:
+                handler.analyze_bucket(BUCKET, workers=args.workers)
+        finally:
+            timer.uninstall()
+            handler.S3_IO_WORKERS = io_workers
+        elapsed = time.perf_counter() - started
+
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{len(keys)} documents in {elapsed:.2f}s: {len(keys) / elapsed:.1f} docs/s "
+          f"(mode={args.mode}, s3-io={io_mode}, latency={args.latency_ms:g} ms), peak RSS {peak_mb:.0f} MB")
+    timer.report()
+    return len(keys) / elapsed
+
+if __name__ == "__main__":
+    main()
@@ -24,12 +24,37 @@ pip3 install \
   --only-binary=:all: \
   -r "$SCRIPT_DIR/requirements.txt"
 
+# Without the rate table every USD equivalent would ship as null, so a
+# deploy refreshes it and refuses to go out without one
+echo "Refreshing NBU rates..."
+if ! python3 "$SCRIPT_DIR/update_fx_rates.py"; then
+  if [[ -f "$SCRIPT_DIR/nbu_rates.csv" ]]; then
+    echo "WARNING: NBU rate refresh failed; shipping the existing nbu_rates.csv"
+  else
+    echo "ERROR: no nbu_rates.csv and update_fx_rates.py failed; USD equivalents would be null"
+    exit 1
+  fi
+fi
+
 echo "Adding handler..."
 cp "$SCRIPT_DIR/handler.py" "$BUILD_DIR/"
+cp "$SCRIPT_DIR/nbu_rates.csv" "$BUILD_DIR/"
+
+# /var/task is read-only, so anything shipped without bytecode is compiled
+# again on every cold start. Keep only bytecode for the Lambda runtime's
+# Python, hash-checked so zip timestamps don't invalidate it.
+echo "Precompiling bytecode..."
+find "$BUILD_DIR" -name '*.pyc' ! -name '*.cpython-312.pyc' -delete
+if command -v python3.12 >/dev/null; then
+  python3.12 -m compileall -q -j 0 --invalidation-mode unchecked-hash "$BUILD_DIR"
+else
+  echo "WARNING: python3.12 not found; shipping sources only"
+  find "$BUILD_DIR" -name '*.pyc' -delete
+fi
 
 echo "Creating zip..."
 cd "$BUILD_DIR"
-zip -r "$ZIP_FILE" . -x '*.pyc' '__pycache__/*'
+zip -r "$ZIP_FILE" .
 
 SIZE=$(du -h "$ZIP_FILE" | cut -f1)
 echo "Package size: $SIZE"
@@ -60,6 +85,14 @@ else
     --profile "$PROFILE"
 fi
 
+# Every handler change starts a new result cache version; drop the ones
+# nothing has written to for RESULT_CACHE_RETENTION_DAYS
+echo "Pruning old result cache versions..."
+AWS_PROFILE="$PROFILE" AWS_DEFAULT_REGION="$REGION" \
+  RESULTS_BUCKET=hromada-partner-docs RESULTS_PREFIX=_analysis/ \
+  python3 "$SCRIPT_DIR/handler.py" --prune-cache \
+  || echo "WARNING: result cache prune failed; rerun handler.py --prune-cache"
+
 echo "Cleaning up..."
 rm -rf "$BUILD_DIR"
 
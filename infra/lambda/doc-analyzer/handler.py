@@ -3,64 +3,469 @@ Hromada Partner Document Analyzer — AWS Lambda Handler
 
 Triggered by S3 PutObject events on hromada-partner-docs bucket.
 For each uploaded document:
-1. Downloads from S3
-2. Extracts text (PDF via PyMuPDF, DOCX via python-docx)
+1. Reads the object from S3 (in memory, or streamed to /tmp when large)
+2. Extracts text (PDF via PyMuPDF, DOCX from its XML, XLSX/XLS sheet by sheet)
 3. Classifies document type
 4. Extracts cost signals (UAH, USD, EUR amounts)
 5. Runs verification checklist against Hromada framework
 6. Writes structured analysis JSON to hromada-partner-docs-staging (or a results prefix)
 """
+import bisect
+import collections
+import contextlib
+import csv
+import functools
+import gzip
+import hashlib
+import importlib.util
+import io
+import itertools
 import json
 import logging
+import math
+import multiprocessing
 import os
 import re
+import resource
+import shutil
+import sqlite3
+import subprocess
 import tempfile
-from datetime import datetime, timezone
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
 from urllib.parse import unquote_plus
+from xml.etree import ElementTree
 
-import boto3
-import fitz  # pymupdf
-from docx import Document
+# boto3, fitz (PyMuPDF), python-docx and numpy are imported where they are
+# first needed: events that are skipped never pay for them, and a DOCX never
+# loads MuPDF. bench/cold_start.py checks the import budget.
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3 = boto3.client("s3")
+
+class LazyClient:
+    """A boto3 client built on first use and shared afterwards. Keyword
+    arguments become its botocore Config."""
+
+    def __init__(self, service: str, **config):
+        self._service = service
+        self._config = config
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+                    from botocore.config import Config
+                    self._client = boto3.client(self._service, config=Config(**self._config))
+        return getattr(self._client, name)
+
+
+# One client is shared by every thread; its connection pool must cover the
+# batch workers plus the background S3 I/O threads (see S3IO), or requests
+# queue for a connection.
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 50))
+
+s3 = LazyClient("s3", max_pool_connections=S3_MAX_POOL_CONNECTIONS)
 
 SOURCE_BUCKET = os.environ.get("SOURCE_BUCKET", "hromada-partner-docs")
 RESULTS_BUCKET = os.environ.get("RESULTS_BUCKET", "hromada-partner-docs")
 RESULTS_PREFIX = os.environ.get("RESULTS_PREFIX", "_analysis/")
 
+# Objects up to INMEMORY_MAX_BYTES are parsed straight from memory; larger ones
+# are streamed to /tmp in chunks. Anything over MAX_DOCUMENT_BYTES is refused.
+INMEMORY_MAX_BYTES = int(os.environ.get("INMEMORY_MAX_BYTES", 32 * 1024 * 1024))
+MAX_DOCUMENT_BYTES = int(os.environ.get("MAX_DOCUMENT_BYTES", 300 * 1024 * 1024))
+STREAM_CHUNK_BYTES = 1024 * 1024
+
 
 # ---------------------------------------------------------------------------
-# Text extraction
+# Stage metrics
 # ---------------------------------------------------------------------------
 
-def extract_pdf(file_path: str) -> dict:
-    doc = fitz.open(file_path)
-    pages = []
-    for i, page in enumerate(doc):
-        text = page.get_text().strip()
-        pages.append({"page": i + 1, "text": text})
-    metadata = doc.metadata or {}
-    full_text = "\n\n".join(p["text"] for p in pages if p["text"])
-    result = {
-        "page_count": len(doc),
-        "metadata": {
-            "title": metadata.get("title", ""),
-            "author": metadata.get("author", ""),
-            "creator": metadata.get("creator", ""),
+# METRICS is a comma-separated set: "emf" prints one CloudWatch Embedded
+# Metric Format line per document (stage wall times, bytes read, pages, peak
+# RSS); "output" also stores the measurements in the analysis as "metrics".
+# Empty (the default) turns the timers into no-ops.
+METRICS = {m.strip() for m in os.environ.get("METRICS", "").split(",") if m.strip()}
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "Hromada/DocAnalyzer")
+
+_NO_STAGE = contextlib.nullcontext()
+
+
+class StageTimer:
+    """Accumulates wall time per pipeline stage, in milliseconds."""
+
+    def __init__(self, enabled: bool | None = None):
+        self.enabled = bool(METRICS) if enabled is None else enabled
+        self.ms = {}
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return _NO_STAGE
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.ms[name] = self.ms.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def merge(self, ms: dict):
+        for name, value in ms.items():
+            self.ms[name] = self.ms.get(name, 0.0) + value
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far (ru_maxrss is KiB on Linux)."""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def document_metrics(timer: StageTimer, bytes_read: int, page_count: int | None) -> dict:
+    return {
+        "stages_ms": {name: round(value, 2) for name, value in timer.ms.items()},
+        "bytes_read": bytes_read,
+        "page_count": page_count,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def emit_emf(s3_key: str, file_type: str, metrics: dict):
+    """Print one EMF record. Lambda's logger prefixes its lines, so EMF goes
+    straight to stdout where CloudWatch picks it up as JSON."""
+    values = {f"{name}_ms": value for name, value in metrics["stages_ms"].items()}
+    values["bytes_read"] = metrics["bytes_read"]
+    values["peak_rss_mb"] = metrics["peak_rss_mb"]
+    if metrics["page_count"] is not None:
+        values["page_count"] = metrics["page_count"]
+    units = {"bytes_read": "Bytes", "peak_rss_mb": "Megabytes", "page_count": "Count"}
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [["file_type"]],
+                "Metrics": [{"Name": name, "Unit": units.get(name, "Milliseconds")} for name in values],
+            }],
         },
-        "pages": pages,
-        "full_text": full_text,
+        "file_type": file_type,
+        "s3_key": s3_key,
+        **values,
+    }
+    print(json.dumps(record, ensure_ascii=False), flush=True)
+
+
+# ---------------------------------------------------------------------------
+# Ingestion
+# ---------------------------------------------------------------------------
+
+def fetch_document(bucket: str, key: str, ext: str) -> tuple:
+    """Read an S3 object for parsing without going through download_file.
+
+    Returns (source, tmp_path): source is the object bytes when it fits under
+    INMEMORY_MAX_BYTES, otherwise the path of a temp file the body was
+    streamed into (tmp_path, which the caller must remove).
+    """
+    response = s3.get_object(Bucket=bucket, Key=key)
+    size = response["ContentLength"]
+    body = response["Body"]
+    if size > MAX_DOCUMENT_BYTES:
+        body.close()
+        raise ValueError(f"{key} is {size} bytes, over MAX_DOCUMENT_BYTES ({MAX_DOCUMENT_BYTES})")
+
+    if size <= INMEMORY_MAX_BYTES:
+        return body.read(), None
+
+    with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
+        for chunk in body.iter_chunks(STREAM_CHUNK_BYTES):
+            tmp.write(chunk)
+    return tmp.name, tmp.name
+
+
+def ingest_document(bucket: str, key: str, result_cache=None) -> dict:
+    """Everything process_document needs from S3 before analysis.
+
+    With a result_cache, HEADs the object for its content digest and returns
+    the cached stages on a hit. Otherwise downloads it (see fetch_document).
+    Returns {"digest", "stages", "source", "tmp_path", "timings"}.
+    """
+    timer = StageTimer()
+    fetched = {"digest": None, "stages": None, "source": None, "tmp_path": None}
+    if result_cache is not None:
+        with timer.stage("cache_lookup"):
+            head = s3.head_object(Bucket=bucket, Key=key, ChecksumMode="ENABLED")
+            fetched["digest"] = content_digest(head)
+            entry = result_cache.get(fetched["digest"])
+            if entry is not None:
+                fetched["stages"] = stages_from_cache(entry, key)
+        if fetched["stages"] is not None:
+            logger.info(f"Cache hit: {key} ({fetched['digest']})")
+
+    if fetched["stages"] is None:
+        with timer.stage("download"):
+            fetched["source"], fetched["tmp_path"] = fetch_document(bucket, key, Path(key).suffix.lower())
+    fetched["timings"] = timer.ms
+    return fetched
+
+
+# ---------------------------------------------------------------------------
+# Background S3 I/O
+# ---------------------------------------------------------------------------
+
+# S3_IO_WORKERS threads run S3 requests off the parsing threads: documents are
+# fetched up to S3_PREFETCH ahead of the ones being analyzed, sibling listings
+# run while a document is parsed, and its result objects are written
+# concurrently. S3_IO_WORKERS=0 keeps every request on the calling thread.
+S3_IO_WORKERS = int(os.environ.get("S3_IO_WORKERS", 16))
+S3_PREFETCH = int(os.environ.get("S3_PREFETCH", 4))
+# Prefetching also stops at a byte budget per place a download lands, counted
+# from the object sizes until the document is done with. Sized for the
+# deployed 512 MB of memory and 512 MB of /tmp: BATCH_WORKERS documents of up
+# to INMEMORY_MAX_BYTES are parsed next to the prefetched ones, and a single
+# MAX_DOCUMENT_BYTES spool has to fit alongside what is already in /tmp.
+S3_PREFETCH_MEMORY_BYTES = int(os.environ.get("S3_PREFETCH_MEMORY_BYTES", 128 * 1024 * 1024))
+S3_PREFETCH_TMP_BYTES = int(os.environ.get("S3_PREFETCH_TMP_BYTES", 192 * 1024 * 1024))
+
+
+class S3IO:
+    """Thread-backed S3 I/O for one batch of documents.
+
+    Threads rather than asyncio: boto3 releases the GIL while it waits on
+    the network, so requests here overlap parsing on the batch workers
+    without a second client stack. Prefetching is bounded so at most
+    `prefetch` downloaded-but-unclaimed documents are held, and the bytes of
+    prefetched documents not yet released stay within `memory_bytes` for
+    in-memory ones and `tmp_bytes` for ones spooled to /tmp. A document is
+    always fetched when nothing else is held, however large.
+    """
+
+    def __init__(self, result_cache=None, workers: int = S3_IO_WORKERS, prefetch: int = S3_PREFETCH,
+                 memory_bytes: int = S3_PREFETCH_MEMORY_BYTES, tmp_bytes: int = S3_PREFETCH_TMP_BYTES):
+        self.result_cache = result_cache
+        self._prefetch = prefetch
+        self._budget = {"memory": memory_bytes, "tmp": tmp_bytes}
+        self._held = {"memory": 0, "tmp": 0}
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="s3io")
+        self._lock = threading.Lock()
+        self._queue = collections.deque()  # (bucket, key, size) not fetched yet
+        self._fetches = {}  # (bucket, key) -> Future of ingest_document()
+        self._reserved = {}  # (bucket, key) -> (spool, size) until release()
+
+    def prefetch(self, items):
+        """Queue (bucket, key, size) in the order they will be claimed. A
+        size of None (an event without one) is read with a HEAD."""
+        items = [
+            (bucket, key, size if size is not None else s3.head_object(Bucket=bucket, Key=key)["ContentLength"])
+            for bucket, key, size in items
+        ]
+        with self._lock:
+            self._queue.extend(items)
+            self._fill()
+
+    def _fill(self):
+        while self._queue and len(self._fetches) < self._prefetch:
+            bucket, key, size = self._queue[0]
+            item = (bucket, key)
+            if item in self._fetches or item in self._reserved:
+                self._queue.popleft()
+                continue
+            spool = "memory" if size <= INMEMORY_MAX_BYTES else "tmp"
+            if self._held[spool] and self._held[spool] + size > self._budget[spool]:
+                break  # claim order is kept: wait for release()
+            self._queue.popleft()
+            self._held[spool] += size
+            self._reserved[item] = (spool, size)
+            self._fetches[item] = self._pool.submit(ingest_document, bucket, key, self.result_cache)
+
+    def fetch(self, bucket: str, key: str) -> dict:
+        """Claim a document: ingest_document() output, prefetched if it was queued."""
+        item = (bucket, key)
+        with self._lock:
+            future = self._fetches.pop(item, None)
+            if future is None:
+                for queued in self._queue:
+                    if queued[:2] == item:
+                        self._queue.remove(queued)
+                        break
+                future = self._pool.submit(ingest_document, bucket, key, self.result_cache)
+            self._fill()
+        try:
+            return future.result()
+        except BaseException:
+            self.release(bucket, key)
+            raise
+
+    def release(self, bucket: str, key: str):
+        """Return a claimed document's bytes to the prefetch budget once its
+        source is no longer held."""
+        with self._lock:
+            reserved = self._reserved.pop((bucket, key), None)
+            if reserved is not None:
+                spool, size = reserved
+                self._held[spool] -= size
+                self._fill()
+
+    def submit(self, fn, *args, **kwargs):
+        return self._pool.submit(fn, *args, **kwargs)
+
+    def close(self):
+        """Wait for submitted work and drop prefetched documents nobody claimed."""
+        with self._lock:
+            self._queue.clear()
+            unclaimed = list(self._fetches.values())
+            self._fetches.clear()
+            self._reserved.clear()
+            self._held = dict.fromkeys(self._held, 0)
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        for future in unclaimed:
+            if future.cancelled() or future.exception() is not None:
+                continue
+            tmp_path = future.result()["tmp_path"]
+            if tmp_path:
+                os.unlink(tmp_path)
+
+
+# ---------------------------------------------------------------------------
+# Text extraction
+# ---------------------------------------------------------------------------
+
+# WordprocessingML tags read by the DOCX fast path
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_BODY, _W_P, _W_R, _W_HYPERLINK = _W + "body", _W + "p", _W + "r", _W + "hyperlink"
+_W_TBL, _W_TR, _W_TC, _W_TRPR, _W_TCPR = _W + "tbl", _W + "tr", _W + "tc", _W + "trPr", _W + "tcPr"
+_W_T, _W_BR, _W_VAL, _W_TYPE = _W + "t", _W + "br", _W + "val", _W + "type"
+# Run children with a fixed text equivalent (as python-docx renders them)
+_W_RUN_CHARS = {_W + "tab": "\t", _W + "ptab": "\t", _W + "cr": "\n", _W + "noBreakHyphen": "-"}
+
+
+def _docx_paragraph_text(p) -> str:
+    """Text of a w:p: its direct runs and hyperlink runs, like python-docx."""
+    parts = []
+    for child in p:
+        if child.tag == _W_R:
+            runs = (child,)
+        elif child.tag == _W_HYPERLINK:
+            runs = child.iterfind(_W_R)
+        else:
+            continue
+        for run in runs:
+            for e in run:
+                if e.tag == _W_T:
+                    parts.append(e.text or "")
+                elif e.tag == _W_BR:
+                    if e.get(_W_TYPE, "textWrapping") == "textWrapping":
+                        parts.append("\n")
+                elif e.tag in _W_RUN_CHARS:
+                    parts.append(_W_RUN_CHARS[e.tag])
+    return "".join(parts)
+
+
+def _w_int(props, tag: str, default: int) -> int:
+    """Integer w:val of a property element; default when the element or its
+    w:val is missing, as Word reads it."""
+    e = props.find(_W + tag) if props is not None else None
+    val = e.get(_W_VAL) if e is not None else None
+    return int(val) if val is not None else default
+
+
+def _docx_table_rows(tbl) -> list:
+    """Rows of a w:tbl, one entry per layout-grid cell like python-docx's
+    row.cells. Each cell's text is built once: horizontally merged cells are
+    repeated and vertically merged ones taken from the row above by grid
+    offset, instead of being re-read for every grid position they cover."""
+    rows = []
+    above = {}
+    for tr in tbl.iterfind(_W_TR):
+        offset = _w_int(tr.find(_W_TRPR), "gridBefore", 0)
+        starts = {}
+        cells = []
+        for tc in tr.iterfind(_W_TC):
+            props = tc.find(_W_TCPR)
+            span = _w_int(props, "gridSpan", 1)
+            vmerge = props.find(_W + "vMerge") if props is not None else None
+            if vmerge is not None and vmerge.get(_W_VAL, "continue") == "continue":
+                if offset not in above:
+                    raise ValueError(f"vertically merged cell has no cell above at grid offset {offset}")
+                cell = above[offset]
+            else:
+                text = "\n".join(_docx_paragraph_text(p) for p in tc.iterfind(_W_P))
+                cell = (text.strip(), span)
+            starts[offset] = cell
+            cells.extend([cell[0]] * cell[1])
+            offset += span
+        rows.append(cells)
+        above = starts
+    return rows
+
+
+def _iter_docx_body(stream):
+    """Yield the top-level blocks of w:body as each one finishes parsing.
+    Blocks are dropped from the tree once consumed, so memory is bounded by
+    the largest single paragraph or table rather than the document."""
+    depth = 0
+    body = None
+    for event, elem in ElementTree.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 2 and elem.tag == _W_BODY:
+                body = elem
+        else:
+            depth -= 1
+            if depth == 2 and body is not None:
+                yield elem
+                body.clear()
+    if body is None:
+        raise ValueError("no w:body in main document part")
+
+
+def _ooxml_main_part(package: zipfile.ZipFile) -> str:
+    rels = ElementTree.fromstring(package.read("_rels/.rels"))
+    for rel in rels:
+        if rel.get("Type", "").endswith("/officeDocument"):
+            return rel.get("Target").lstrip("/")
+    raise KeyError("no officeDocument relationship")
+
+
+def extract_docx_xml(source: str | bytes) -> dict:
+    """extract_docx output streamed straight from the main document XML,
+    without building python-docx's object model."""
+    paragraphs = []
+    tables = []
+    with zipfile.ZipFile(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source) as package:
+        with package.open(_ooxml_main_part(package)) as stream:
+            for block in _iter_docx_body(stream):
+                if block.tag == _W_P:
+                    text = _docx_paragraph_text(block)
+                    if text.strip():
+                        paragraphs.append(text)
+                elif block.tag == _W_TBL:
+                    tables.append({"table_index": len(tables), "rows": _docx_table_rows(block)})
+    return {
+        "paragraphs": paragraphs,
+        "tables": tables,
+        "full_text": "\n".join(paragraphs),
     }
-    doc.close()
-    return result
 
 
-def extract_docx(file_path: str) -> dict:
-    doc = Document(file_path)
+def extract_docx(source: str | bytes) -> dict:
+    try:
+        return extract_docx_xml(source)
+    except (zipfile.BadZipFile, KeyError, ValueError, ElementTree.ParseError) as e:
+        logger.info(f"DOCX fast path failed ({e!r}), falling back to python-docx")
+
+    from docx import Document
+
+    doc = Document(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
     paragraphs = [p.text for p in doc.paragraphs if p.text.strip()]
     tables = []
     for i, table in enumerate(doc.tables):
@@ -76,6 +481,525 @@ def extract_docx(file_path: str) -> dict:
     }
 
 
+class DocumentText:
+    """Document text extracted page by page, only as far as callers ask.
+
+    prefix(n) is always equal to full()[:n] (non-empty pages joined by a
+    blank line), but stops extracting once n characters are
+    available, so analyzers that only read the opening of a 300-page drawing
+    set never touch the rest of it.
+    """
+
+    def __init__(self, page_count: int, load_page, close=None, metadata: dict = None):
+        self.page_count = page_count
+        self.metadata = metadata or {}
+        self.loader = load_page
+        self._close = close
+        self._texts = []  # non-empty page texts, in page order
+        self._length = 0  # len("\n\n".join(self._texts))
+        self.page_starts = []  # [page number, offset of its text in extracted()]
+        self._joined = ""
+        self.pages_extracted = 0
+
+    @classmethod
+    def from_text(cls, text: str, metadata: dict = None) -> "DocumentText":
+        return cls(1, lambda i: text, metadata=metadata)
+
+    @property
+    def complete(self) -> bool:
+        return self.pages_extracted >= self.page_count
+
+    def _extract_next(self):
+        text = self.loader(self.pages_extracted)
+        self.pages_extracted += 1
+        if text:
+            self._length += 2 if self._texts else 0
+            self.page_starts.append([self.pages_extracted, self._length])
+            self._length += len(text)
+            self._texts.append(text)
+            self._joined = None
+
+    def extracted(self) -> str:
+        """Text of every page extracted so far."""
+        if self._joined is None:
+            self._joined = "\n\n".join(self._texts)
+        return self._joined
+
+    def prefix(self, chars: int) -> str:
+        while self._length < chars and not self.complete:
+            self._extract_next()
+        return self.extracted()[:chars]
+
+    def first_pages(self, pages: int) -> str:
+        """Extract at least the first `pages` pages; return all text extracted so far."""
+        while self.pages_extracted < min(pages, self.page_count):
+            self._extract_next()
+        return self.extracted()
+
+    def full(self) -> str:
+        return self.first_pages(self.page_count)
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+
+def load_document_text(source: str | bytes, ext: str) -> DocumentText:
+    """Open a document for lazy extraction. PDFs are read page by page and
+    workbooks sheet by sheet; DOCX text comes out in one piece."""
+    if ext in SPREADSHEET_EXTENSIONS:
+        book = XlsxBook(source) if ext == ".xlsx" else XlsBook(source)
+        return DocumentText(len(book.sheet_names), SheetLoader(book), close=book.close)
+    if ext != ".pdf":
+        return DocumentText.from_text(extract_docx(source)["full_text"])
+
+    import fitz  # pymupdf
+
+    if isinstance(source, (bytes, bytearray)):
+        doc = fitz.open(stream=source, filetype="pdf")
+    else:
+        doc = fitz.open(source)
+    metadata = doc.metadata or {}
+    return DocumentText(
+        len(doc),
+        PdfPageLoader(doc),
+        close=doc.close,
+        metadata={
+            "title": metadata.get("title", ""),
+            "author": metadata.get("author", ""),
+            "creator": metadata.get("creator", ""),
+        },
+    )
+
+
+# ---------------------------------------------------------------------------
+# OCR fallback for scanned pages
+# ---------------------------------------------------------------------------
+
+# Pages with no text layer but with images are rendered and run through the
+# tesseract CLI, at most OCR_MAX_PAGES per document (0 turns OCR off). Several
+# pages go through tesseract at once, and results are cached on disk by a
+# hash of the rendered page so re-uploads and retries don't pay twice.
+OCR_MAX_PAGES = int(os.environ.get("OCR_MAX_PAGES", 0))
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", 4))
+OCR_LANGUAGES = os.environ.get("OCR_LANGUAGES", "ukr+eng")
+OCR_DPI = int(os.environ.get("OCR_DPI", 200))
+OCR_COMMAND = os.environ.get("OCR_COMMAND", "tesseract")
+OCR_CACHE_DIR = os.environ.get("OCR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ocr-cache"))
+OCR_TIMEOUT_SECONDS = 60
+
+_ocr_available = None
+
+
+def ocr_available() -> bool:
+    global _ocr_available
+    if _ocr_available is None:
+        _ocr_available = OCR_MAX_PAGES > 0 and shutil.which(OCR_COMMAND) is not None
+        if OCR_MAX_PAGES > 0 and not _ocr_available:
+            logger.warning(f"OCR_MAX_PAGES is set but {OCR_COMMAND} was not found; OCR disabled")
+    return _ocr_available
+
+
+def ocr_image(png: bytes) -> str:
+    """OCR one rendered page, memoized on disk by content hash."""
+    digest = hashlib.sha256(png + OCR_LANGUAGES.encode()).hexdigest()
+    cache_path = Path(OCR_CACHE_DIR) / f"{digest}.txt"
+    if cache_path.exists():
+        return cache_path.read_text(encoding="utf-8")
+
+    completed = subprocess.run(
+        [OCR_COMMAND, "stdin", "stdout", "-l", OCR_LANGUAGES],
+        input=png,
+        capture_output=True,
+        timeout=OCR_TIMEOUT_SECONDS,
+        check=True,
+    )
+    text = completed.stdout.decode("utf-8", errors="replace").strip()
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(text, encoding="utf-8")
+    tmp.replace(cache_path)
+    return text
+
+
+class PdfPageLoader:
+    """Page text for DocumentText, falling back to OCR for scanned pages.
+
+    When a text-less page with images is reached, it and the next text-less
+    pages (up to OCR_WORKERS, within the remaining budget) are rendered and
+    OCR'd together.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.ocr_pages = 0
+        self._native = {}
+        self._ocr = {}
+
+    def _native_text(self, i: int) -> str:
+        if i not in self._native:
+            self._native[i] = self.doc[i].get_text().strip()
+        return self._native[i]
+
+    def _needs_ocr(self, i: int) -> bool:
+        return not self._native_text(i) and bool(self.doc[i].get_images())
+
+    def __call__(self, i: int) -> str:
+        text = self._native.pop(i, None)
+        if text is None:
+            text = self.doc[i].get_text().strip()
+        if text or not ocr_available():
+            return text
+        if i not in self._ocr and self.ocr_pages < OCR_MAX_PAGES and self.doc[i].get_images():
+            self._ocr_batch(i)
+        return self._ocr.pop(i, "")
+
+    def _ocr_batch(self, start: int):
+        batch = [start]
+        limit = min(OCR_WORKERS, OCR_MAX_PAGES - self.ocr_pages)
+        j = start + 1
+        while len(batch) < limit and j < len(self.doc):
+            if self._needs_ocr(j):
+                batch.append(j)
+            j += 1
+        self.ocr_pages += len(batch)
+
+        # Rendering stays on this thread (MuPDF documents aren't thread-safe);
+        # only the tesseract runs overlap
+        import fitz  # pymupdf
+
+        images = [
+            self.doc[i].get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY).tobytes("png")
+            for i in batch
+        ]
+        with ThreadPoolExecutor(max_workers=len(batch)) as pool:
+            futures = [pool.submit(ocr_image, png) for png in images]
+            for i, future in zip(batch, futures):
+                try:
+                    self._ocr[i] = future.result()
+                except (subprocess.SubprocessError, OSError):
+                    logger.exception(f"OCR failed on page {i + 1}")
+                    self._ocr[i] = ""
+
+
+# ---------------------------------------------------------------------------
+# Spreadsheets (XLSX/XLS estimates)
+# ---------------------------------------------------------------------------
+
+# Sheets are the "pages" of a workbook. Each is streamed row by row once:
+# rows become tab-separated text lines, and rows under an estimate header go
+# straight into a CostTableBuilder with their numbers as typed cell values.
+# Cost signals come from the cells too, not from the joined text, where
+# neighbouring numbers run together and a currency shown only through the
+# number format isn't there at all. A number cell is an amount when its
+# format names a currency, a neighbouring cell is just a currency marker
+# ("грн"), or a header cell above it names one ("Вартість, грн").
+SPREADSHEET_EXTENSIONS = (".xlsx", ".xls")
+SHEET_HEADER_SCAN_ROWS = 40
+
+_TOKEN_CURRENCY = {"грн": "UAH", "грив": "UAH", "UAH": "UAH", "EUR": "EUR", "євро": "EUR", "€": "EUR",
+                   "USD": "USD", "дол": "USD", "$": "USD"}
+_FORMAT_CURRENCIES = (("грн", "UAH"), ("₴", "UAH"), ("UAH", "UAH"), ("€", "EUR"), ("EUR", "EUR"),
+                      ("$", "USD"), ("USD", "USD"))
+_FORMAT_LOCALE_RE = re.compile(r"\[\$([^\]-]*)[^\]]*\]")  # [$₴-422] -> ₴
+_FORMAT_BRACKET_RE = re.compile(r"\[[^\]]*\]")  # colours, conditions
+
+
+class CurrencyAmount(float):
+    """A number cell whose number format shows a currency."""
+
+    def __new__(cls, value: float, currency: str):
+        amount = super().__new__(cls, value)
+        amount.currency = currency
+        return amount
+
+
+@functools.lru_cache(maxsize=256)
+def format_currency(code: str) -> str | None:
+    """Currency a custom number format code displays, or None."""
+    code = _FORMAT_BRACKET_RE.sub("", _FORMAT_LOCALE_RE.sub(r"\1", code))
+    for token, currency in _FORMAT_CURRENCIES:
+        if token in code:
+            return currency
+    return None
+
+
+def _marker_currency(text: str) -> str | None:
+    """Currency of a cell that holds nothing but a currency marker."""
+    match = _CURRENCY_TOKEN_RE.fullmatch(text.strip().rstrip("."))
+    return _TOKEN_CURRENCY[match.group(0)] if match else None
+
+_X = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_X_ROW, _X_C, _X_V, _X_T, _X_R = _X + "row", _X + "c", _X + "v", _X + "t", _X + "r"
+_R_ID = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+
+
+@functools.lru_cache(maxsize=4096)
+def _column_number(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch.upper()) - 64
+    return n - 1
+
+
+def _column_index(ref: str) -> int:
+    """Zero-based column of an A1-style cell reference."""
+    return _column_number(ref.rstrip("0123456789"))
+
+
+def _xlsx_string(si) -> str:
+    """Text of a shared or inline string: plain or rich runs, without the
+    phonetic (rPh) annotations."""
+    t = si.find(_X_T)
+    if t is not None:
+        return t.text or ""
+    return "".join(r.findtext(_X_T) or "" for r in si.iterfind(_X_R))
+
+
+class XlsxBook:
+    """Streaming .xlsx reader: worksheet XML is parsed row by row straight
+    from the zip, and each row is dropped once consumed."""
+
+    def __init__(self, source: str | bytes):
+        self.package = zipfile.ZipFile(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+        workbook = _ooxml_main_part(self.package)
+        folder, _, name = workbook.rpartition("/")
+        base = folder + "/" if folder else ""
+
+        targets = {}
+        shared_strings = styles = None
+        for rel in ElementTree.fromstring(self.package.read(f"{base}_rels/{name}.rels")):
+            target = rel.get("Target")
+            target = target.lstrip("/") if target.startswith("/") else base + target
+            targets[rel.get("Id")] = target
+            if rel.get("Type", "").endswith("/sharedStrings"):
+                shared_strings = target
+            elif rel.get("Type", "").endswith("/styles"):
+                styles = target
+
+        self.sheet_names = []
+        self._sheet_parts = []
+        for sheet in ElementTree.fromstring(self.package.read(workbook)).iter(_X + "sheet"):
+            self.sheet_names.append(sheet.get("name"))
+            self._sheet_parts.append(targets[sheet.get(_R_ID)])
+        self.strings = self._read_strings(shared_strings) if shared_strings else []
+        self.style_currencies = self._read_style_currencies(styles) if styles else []
+
+    def _read_style_currencies(self, part: str) -> list:
+        """Currency shown by each cell style (cellXfs entry), or None.
+        Only custom formats are read; the built-in currency formats follow
+        the reader's locale."""
+        root = ElementTree.fromstring(self.package.read(part))
+        codes = {fmt.get("numFmtId"): fmt.get("formatCode", "") for fmt in root.iter(_X + "numFmt")}
+        xfs = root.find(_X + "cellXfs")
+        if xfs is None:
+            return []
+        return [format_currency(codes[xf.get("numFmtId")]) if xf.get("numFmtId") in codes else None
+                for xf in xfs.iterfind(_X + "xf")]
+
+    def _read_strings(self, part: str) -> list:
+        strings = []
+        with self.package.open(part) as stream:
+            for _, elem in ElementTree.iterparse(stream):
+                if elem.tag == _X + "si":
+                    strings.append(_xlsx_string(elem))
+                    elem.clear()
+        return strings
+
+    def _value(self, c):
+        kind = c.get("t", "n")
+        if kind == "inlineStr":
+            inline = c.find(_X + "is")
+            return _xlsx_string(inline) if inline is not None else None
+        v = c.findtext(_X_V)
+        if v is None:
+            return None
+        if kind == "s":
+            return self.strings[int(v)]
+        if kind == "n":
+            try:
+                value = float(v)
+            except ValueError:
+                return v
+            style = c.get("s")
+            if style and int(style) < len(self.style_currencies) and self.style_currencies[int(style)]:
+                return CurrencyAmount(value, self.style_currencies[int(style)])
+            return value
+        if kind == "b":
+            return v == "1"
+        return v  # str (formula result), e (error), d (ISO date)
+
+    def rows(self, index: int):
+        # End events only (start events double the parser callbacks); a
+        # consumed row is emptied, leaving a bare element behind
+        with self.package.open(self._sheet_parts[index]) as stream:
+            for _, elem in ElementTree.iterparse(stream):
+                if elem.tag == _X_ROW:
+                    values = []
+                    for c in elem.iterfind(_X_C):
+                        ref = c.get("r")
+                        if ref:
+                            column = _column_index(ref)
+                            if column > len(values):
+                                values.extend([None] * (column - len(values)))
+                        values.append(self._value(c))
+                    yield values
+                    elem.clear()
+
+    def close(self):
+        self.package.close()
+
+
+class XlsBook:
+    """Legacy .xls (BIFF) through xlrd, loading one sheet at a time."""
+
+    def __init__(self, source: str | bytes):
+        import xlrd
+
+        self._xlrd = xlrd
+        # formatting_info for the number formats, which carry the currency
+        if isinstance(source, (bytes, bytearray)):
+            self.book = xlrd.open_workbook(file_contents=source, on_demand=True, formatting_info=True)
+        else:
+            self.book = xlrd.open_workbook(source, on_demand=True, formatting_info=True)
+        self.sheet_names = self.book.sheet_names()
+        formats = self.book.format_map
+        self.style_currencies = [
+            format_currency(formats[xf.format_key].format_str) if xf.format_key in formats else None
+            for xf in self.book.xf_list
+        ]
+
+    def _value(self, cell):
+        xlrd = self._xlrd
+        if cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+            return None
+        if cell.ctype == xlrd.XL_CELL_NUMBER and cell.xf_index < len(self.style_currencies):
+            currency = self.style_currencies[cell.xf_index]
+            if currency:
+                return CurrencyAmount(cell.value, currency)
+        if cell.ctype in (xlrd.XL_CELL_NUMBER, xlrd.XL_CELL_DATE):
+            return float(cell.value)
+        if cell.ctype == xlrd.XL_CELL_BOOLEAN:
+            return bool(cell.value)
+        if cell.ctype == xlrd.XL_CELL_ERROR:
+            return xlrd.error_text_from_code.get(cell.value, "#ERR")
+        return cell.value
+
+    def rows(self, index: int):
+        sheet = self.book.sheet_by_index(index)
+        try:
+            for r in range(sheet.nrows):
+                yield [self._value(cell) for cell in sheet.row(r)]
+        finally:
+            self.book.unload_sheet(index)
+
+    def close(self):
+        self.book.release_resources()
+
+
+def _sheet_header(rows: list) -> tuple:
+    """Find an estimate header under a sheet's title rows: the first row
+    naming the line-item column that _table_header accepts."""
+    name_keywords = dict(COST_TABLE_COLUMNS)["name"]
+    for i, row in enumerate(rows):
+        if any(k in _cell_text(cell).lower() for cell in row for k in name_keywords):
+            columns, start = _table_header(rows[i:])
+            if columns is not None:
+                return columns, i + start
+    return None, 0
+
+
+def _row_amounts(row: list, texts: list, column_currency: dict, header: bool) -> list:
+    """Currency amounts in one sheet row, as scan_currency_amounts() tuples
+    with offsets into "\\t".join(texts). Header rows record the currency a
+    column heading names in column_currency."""
+    amounts = []
+    end = -1
+    for c, (cell, text) in enumerate(zip(row, texts)):
+        start, end = end + 1, end + 1 + len(text)
+        if isinstance(cell, str):
+            found = scan_currency_amounts(cell)
+            if found:
+                amounts += [(value, currency, start + a, start + b) for value, currency, a, b in found]
+                continue
+            value = _parse_number(cell)
+            if math.isnan(value):
+                token = _CURRENCY_TOKEN_RE.search(cell) if header else None
+                if token and "тис" not in cell.lower():
+                    column_currency[c] = _TOKEN_CURRENCY[token.group(0)]
+                continue
+        elif isinstance(cell, float):
+            value = cell
+        else:
+            continue
+
+        span = (start, end)
+        currency = getattr(cell, "currency", None)
+        if currency is None and c + 1 < len(texts) and (currency := _marker_currency(texts[c + 1])):
+            span = (start, end + 1 + len(texts[c + 1]))
+        elif currency is None and c > 0 and (currency := _marker_currency(texts[c - 1])):
+            span = (start - 1 - len(texts[c - 1]), end)
+        currency = currency or column_currency.get(c)
+        if currency:
+            amounts.append((value, currency, *span))
+    return amounts
+
+
+class SheetLoader:
+    """DocumentText page loader over the sheets of a workbook."""
+
+    def __init__(self, book):
+        self.book = book
+        self.cost_table = CostTableBuilder()
+        self._amounts = {}  # sheet index -> amounts, offsets into the sheet's text
+
+    def amounts(self, page_starts: list) -> list:
+        """Amounts in every sheet read so far, as scan_currency_amounts()
+        tuples with offsets into DocumentText.extracted()."""
+        return [
+            (value, currency, page_start + start, page_start + end)
+            for page, page_start in page_starts
+            for value, currency, start, end in self._amounts.get(page - 1, ())
+        ]
+
+    def __call__(self, index: int) -> str:
+        lines = [self.book.sheet_names[index]]
+        amounts = self._amounts[index] = []
+        column_currency = {}
+        position = len(lines[0]) + 1
+
+        def rows_with_text():
+            nonlocal position
+            for r, row in enumerate(self.book.rows(index)):
+                texts = [_cell_text(cell) for cell in row]
+                joined = "\t".join(texts)
+                line = joined.strip()
+                if line:
+                    # Offsets move from the joined cells to the stripped line
+                    lead = len(joined) - len(joined.lstrip())
+                    amounts.extend(
+                        (value, currency, position + max(start - lead, 0), position + min(end - lead, len(line)))
+                        for value, currency, start, end in _row_amounts(row, texts, column_currency,
+                                                                        r < SHEET_HEADER_SCAN_ROWS)
+                    )
+                    lines.append(line)
+                    position += len(line) + 1
+                yield row
+
+        rows = rows_with_text()
+        head = list(itertools.islice(rows, SHEET_HEADER_SCAN_ROWS))
+        columns, start = _sheet_header(head)
+        if columns is not None:
+            self.cost_table.add_rows(itertools.chain(head[start:], rows), columns, index + 1,
+                                     _table_units(head, columns, start))
+        else:
+            for _ in rows:
+                pass
+        return "\n".join(lines)
+
+
 # ---------------------------------------------------------------------------
 # Classification
 # ---------------------------------------------------------------------------
@@ -97,14 +1021,47 @@ CLASSIFICATION_RULES = [
 ]
 
 
-def classify_document(s3_key: str, text: str) -> str:
-    filename = s3_key.lower()
-    text_start = text[:1000].lower()
+class DocumentClassifier:
+    """First-match scan over CLASSIFICATION_RULES, memoized for filenames.
+
+    The scan is the same linear one as before: one substring search per rule
+    and source, first rule wins. The result also names the pattern that
+    fired and whether it was found in the filename or the text. What is
+    saved is repeat work: filename-only lookups, which run for every sibling
+    and partner file on every event, come from an LRU memo.
+    """
+
+    def __init__(self, rules: list, memo_size: int = 1 << 18):
+        self.rules = tuple(rules)
+        self.classify_filename = functools.lru_cache(maxsize=memo_size)(self._classify_filename)
+
+    def _classify_filename(self, s3_key: str) -> tuple:
+        filename = s3_key.lower()
+        for pattern, doc_type in self.rules:
+            if pattern in filename:
+                return doc_type, pattern, "filename"
+        return "unknown", None, None
 
-    for pattern, doc_type in CLASSIFICATION_RULES:
-        if pattern in filename or pattern in text_start:
-            return doc_type
-    return "unknown"
+    def classify(self, s3_key: str, text: str) -> tuple:
+        """Return (doc_type, pattern, source) where source is "filename" or
+        "text"; pattern and source are None for unknown documents."""
+        if not text:
+            return self.classify_filename(s3_key)
+        filename = s3_key.lower()
+        text_start = text[:1000].lower()
+        for pattern, doc_type in self.rules:
+            if pattern in filename:
+                return doc_type, pattern, "filename"
+            if pattern in text_start:
+                return doc_type, pattern, "text"
+        return "unknown", None, None
+
+
+CLASSIFIER = DocumentClassifier(CLASSIFICATION_RULES)
+
+
+def classify_document(s3_key: str, text: str) -> str:
+    return CLASSIFIER.classify(s3_key, text)[0]
 
 
 # ---------------------------------------------------------------------------
@@ -119,21 +1076,129 @@ CURRENCY_PATTERNS = [
 ]
 
 
-def extract_cost_signals(text: str) -> dict:
+# All four patterns are keyed on a currency marker, so instead of four
+# finditer passes (each backtracking over every run of digits and spaces) we
+# find the markers in one sweep and resolve the number next to each marker
+# locally. scan_currency_amounts() returns exactly the matches the
+# CURRENCY_PATTERNS finditer passes would, in the same order.
+_CURRENCY_TOKEN_RE = re.compile(r'грн|грив|UAH|EUR|євро|€|USD|дол|\$')
+_SUFFIX_TOKEN_PATTERN = {"грн": 0, "грив": 0, "EUR": 2, "євро": 2, "€": 2, "USD": 3, "дол": 3, "$": 3}
+_PREFIX_TOKEN_PATTERN = {"UAH": 1, "грн": 1}
+
+
+def _number_before(text: str, pos: int) -> tuple:
+    """Span of ([\d\s]+[\d.,]+)\s* ending at pos, or None."""
+    t = pos
+    while t > 0 and text[t - 1].isspace():
+        t -= 1
+    u = t
+    while u > 0 and (text[u - 1].isdecimal() or text[u - 1] in ".,"):
+        u -= 1
+
+    # The leftmost [\d\s] run that ends on a separator inside the last
+    # [\d.,] group matches with that group as its tail
+    for q in range(u, t):
+        if text[q] in ".," and q > 0 and (text[q - 1].isdecimal() or text[q - 1].isspace()):
+            a = q - 1
+            while a > 0 and (text[a - 1].isdecimal() or text[a - 1].isspace()):
+                a -= 1
+            return a, t
+
+    # Otherwise only the [\d\s] run right before the marker can match, and
+    # it needs at least two characters up to its last digit
+    if u == t or not text[t - 1].isdecimal():
+        return None
+    a = pos
+    while a > 0 and (text[a - 1].isdecimal() or text[a - 1].isspace()):
+        a -= 1
+    if t - a < 2:
+        return None
+    return a, t
+
+
+def _number_after(text: str, pos: int) -> tuple:
+    """Span of \s*([\d\s]+[\d.,]+) starting at pos, or None."""
+    n = len(text)
+    w = pos
+    while w < n and text[w].isspace():
+        w += 1
+    if w == n:
+        return None
+
+    if not text[w].isdecimal():
+        # Only a separator right after the spaces can still match, with the
+        # last space standing in for the [\d\s]+ part
+        if w == pos or text[w] not in ".,":
+            return None
+        t = w + 1
+        while t < n and (text[t].isdecimal() or text[t] in ".,"):
+            t += 1
+        return w - 1, t
+
+    r = w + 1
+    while r < n and (text[r].isdecimal() or text[r].isspace()):
+        r += 1
+    if r < n and text[r] in ".,":
+        t = r + 1
+        while t < n and (text[t].isdecimal() or text[t] in ".,"):
+            t += 1
+        return w, t
+
+    t = r
+    while text[t - 1].isspace():
+        t -= 1
+    if t - w >= 2:
+        return w, t
+    if w > pos:
+        return w - 1, w + 1
+    return None
+
+
+def scan_currency_amounts(text: str) -> list:
+    """Find currency amounts in one sweep over text.
+
+    Returns (value, currency, start, end) tuples, where text[start:end] is
+    the full match and value the parsed number, in CURRENCY_PATTERNS order.
+    Numbers that don't parse as floats are dropped.
+    """
+    matches = [[] for _ in CURRENCY_PATTERNS]
+    for token in _CURRENCY_TOKEN_RE.finditer(text):
+        marker = token.group(0)
+        index = _SUFFIX_TOKEN_PATTERN.get(marker)
+        if index is not None:
+            span = _number_before(text, token.start())
+            if span is not None:
+                matches[index].append((span[0], token.end(), span[0], span[1]))
+        index = _PREFIX_TOKEN_PATTERN.get(marker)
+        if index is not None:
+            end = token.end()
+            if marker == "грн" and text[end:end + 1] == ".":
+                end += 1
+            span = _number_after(text, end)
+            if span is not None:
+                matches[index].append((token.start(), span[1], span[0], span[1]))
+
     amounts = []
-    for pattern, currency in CURRENCY_PATTERNS:
-        for match in re.finditer(pattern, text):
-            raw = match.group(1).replace(" ", "").replace(",", ".")
+    for (_, currency), found in zip(CURRENCY_PATTERNS, matches):
+        for start, end, num_start, num_end in found:
+            raw = text[num_start:num_end].replace(" ", "").replace(",", ".")
             try:
-                val = float(raw)
-                if val > 100:
-                    amounts.append({
-                        "raw": match.group(0).strip()[:80],
-                        "value": val,
-                        "currency": currency,
-                    })
+                amounts.append((float(raw), currency, start, end))
             except ValueError:
                 pass
+    return amounts
+
+
+def extract_cost_signals(text: str, scanned: list = None) -> dict:
+    """scanned is scan_currency_amounts(text), if the caller already has it."""
+    amounts = []
+    for val, currency, start, end in scan_currency_amounts(text) if scanned is None else scanned:
+        if val > 100:
+            amounts.append({
+                "raw": text[start:end].strip()[:80],
+                "value": val,
+                "currency": currency,
+            })
 
     # Deduplicate by value+currency
     seen = set()
@@ -150,13 +1215,367 @@ def extract_cost_signals(text: str) -> dict:
         "amounts": unique[:30],
         "max_amount": unique[0] if unique else None,
         "total_uah": sum(a["value"] for a in unique if a["currency"] == "UAH"),
+        "by_currency": currency_aggregates(unique),
+    }
+
+
+CURRENCIES = ("UAH", "USD", "EUR")
+
+
+def currency_aggregates(amounts: list) -> dict:
+    """{currency: {"count", "sum"}} over every extracted amount, not just
+    the 30 listed ones."""
+    if not amounts:
+        return {}
+
+    import numpy as np
+
+    codes = np.array([CURRENCIES.index(a["currency"]) for a in amounts])
+    values = np.array([a["value"] for a in amounts])
+    counts = np.bincount(codes, minlength=len(CURRENCIES))
+    sums = np.bincount(codes, weights=values, minlength=len(CURRENCIES))
+    return {
+        currency: {"count": int(counts[i]), "sum": round(float(sums[i]), 2)}
+        for i, currency in enumerate(CURRENCIES)
+        if counts[i]
+    }
+
+
+# ---------------------------------------------------------------------------
+# Cost tables (structured line items from кошторис PDFs)
+# ---------------------------------------------------------------------------
+
+# Header keywords per line-item column. Checked in this order, so "вартість
+# одиниці" is a unit price rather than a unit or a total.
+COST_TABLE_COLUMNS = [
+    ("unit_price", ("вартість одиниці", "ціна за од", "ціна од", "ціна")),
+    ("total", ("загальна вартість", "загальна", "сума", "всього", "вартість")),
+    ("quantity", ("кількість", "к-сть", "к-ть")),
+    ("unit", ("одиниц", "од. вим", "од.вим")),
+    ("name", ("найменування", "назва")),
+]
+COST_TABLE_SUMMARY_ROWS = ("разом", "всього", "усього", "итого", "підсумок", "в тому числі", "у тому числі")
+COST_TABLE_HEADER_ROWS = 4
+# Money column headings often carry the unit: "Загальна вартість, тис. грн"
+COST_TABLE_SCALES = (("млн", 1_000_000.0), ("тис", 1000.0))
+TABLE_MAX_PAGES = int(os.environ.get("TABLE_MAX_PAGES", 200))
+
+
+def _cell_text(cell) -> str:
+    """A table cell as text. PDF cells are strings or None; spreadsheet
+    numbers print without a trailing .0 when they are whole."""
+    if cell is None:
+        return ""
+    if isinstance(cell, float):
+        return str(int(cell)) if cell.is_integer() else repr(cell)
+    return str(cell)
+
+
+def _table_header(rows: list) -> tuple:
+    """Map line-item columns to cell indexes from a table's first rows.
+
+    Returns ({column: index}, first_data_row), or (None, 0) when the rows
+    don't look like an estimate header.
+    """
+    columns = {}
+    data_start = 0
+    for r, row in enumerate(rows[:COST_TABLE_HEADER_ROWS]):
+        matched = False
+        for c, cell in enumerate(row):
+            label = _cell_text(cell).lower().replace("\n", " ")
+            for column, keywords in COST_TABLE_COLUMNS:
+                if column not in columns and c not in columns.values() and any(k in label for k in keywords):
+                    columns[column] = c
+                    matched = True
+                    break
+        if matched:
+            data_start = r + 1
+    if "name" not in columns or "quantity" not in columns or not ({"total", "unit_price"} & columns.keys()):
+        return None, 0
+
+    # AVK-5 numbers its columns 1, 2, 3... in the row under the header
+    if data_start < len(rows):
+        numbering = [_cell_text(cell).strip() for cell in rows[data_start]]
+        if all(cell.isdigit() for cell in numbering if cell) and any(numbering):
+            data_start += 1
+    return columns, data_start
+
+
+def _table_units(rows: list, columns: dict, data_start: int) -> tuple:
+    """(scale, currency) the money column headings above data_start name.
+
+    The total column's heading wins over the unit price's. A heading merged
+    across both ("Вартість, тис. грн" over "одиниці" / "загальна") sits in
+    the leftmost cell of the span, the rest of which PDF tables leave None.
+    currency is None when no heading names one.
+    """
+    other = {c for column, c in columns.items() if column not in ("unit_price", "total")}
+    scale, currency = 1.0, None
+    for column in ("unit_price", "total"):
+        if column not in columns:
+            continue
+        cells = []
+        for row in rows[:data_start]:
+            c = min(columns[column], len(row) - 1)
+            while c > 0 and row[c] is None and c - 1 not in other:
+                c -= 1
+            cells.append(_cell_text(row[c]) if c >= 0 else "")
+        label = " ".join(cells)
+        column_scale = next((factor for word, factor in COST_TABLE_SCALES if word in label.lower()), None)
+        token = _CURRENCY_TOKEN_RE.search(label) or _CURRENCY_TOKEN_RE.search(label.lower())
+        if column_scale is not None:
+            scale = column_scale
+        if token:
+            currency = _TOKEN_CURRENCY[token.group(0)]
+    return scale, currency
+
+
+_WHITESPACE_RE = re.compile(r"\s")
+
+
+def _parse_number(cell) -> float:
+    if isinstance(cell, (int, float)):
+        return float(cell)
+    if not cell:
+        return math.nan
+    try:
+        return float(_WHITESPACE_RE.sub("", cell).replace(",", "."))
+    except ValueError:
+        return math.nan
+
+
+class CostTableBuilder:
+    """Collects estimate line items from table rows, then totals them.
+
+    Rows are consumed as they come, so a spreadsheet never has to be held in
+    memory; cells may be strings (PDF) or typed numbers (spreadsheets).
+    Money cells are scaled by the headings' unit (see _table_units()).
+    """
+
+    def __init__(self):
+        self.names, self.units, self.quantities = [], [], []
+        self.unit_prices, self.totals, self.pages = [], [], []
+        self.currencies = set()
+
+    def add_rows(self, rows, columns: dict, page: int, units: tuple = (1.0, None)):
+        scale, currency = units
+        width = max(columns.values()) + 1
+        for row in rows:
+            if len(row) < width:
+                row = list(row) + [None] * (width - len(row))
+            name = _cell_text(row[columns["name"]]).replace("\n", " ").strip()
+            if not name or name.lower().startswith(COST_TABLE_SUMMARY_ROWS):
+                continue
+            self.names.append(name)
+            self.units.append(_cell_text(row[columns["unit"]]).strip() if "unit" in columns else "")
+            self.quantities.append(_parse_number(row[columns["quantity"]]))
+            self.unit_prices.append(_parse_number(row[columns["unit_price"]]) * scale
+                                    if "unit_price" in columns else math.nan)
+            self.totals.append(_parse_number(row[columns["total"]]) * scale if "total" in columns else math.nan)
+            self.pages.append(page)
+            self.currencies.add(currency)
+
+    def result(self) -> dict | None:
+        """Columnar line items and totals, or None if there are none.
+
+        currency is the one the money headings name, None when they name
+        none or disagree; total_uah is set only for hryvnia tables.
+        """
+        if not self.names:
+            return None
+
+        import numpy as np
+
+        quantity = np.array(self.quantities)
+        unit_price = np.array(self.unit_prices)
+        computed = quantity * unit_price
+        total = np.array(self.totals)
+        total = np.where(np.isnan(total), computed, total)
+        keep = ~np.isnan(quantity) & ~np.isnan(total)
+        if not keep.any():
+            return None
+        currency = next(iter(self.currencies)) if len(self.currencies) == 1 else None
+
+        def column(values):
+            return [None if isinstance(v, float) and math.isnan(v) else v for v in np.asarray(values)[keep].tolist()]
+
+        return {
+            "line_items": int(keep.sum()),
+            "columns": {
+                "name": column(self.names),
+                "unit": column(self.units),
+                "quantity": column(quantity),
+                "unit_price": column(unit_price),
+                "total": column(total),
+                "page": column(self.pages),
+            },
+            "currency": currency,
+            "total": round(float(total[keep].sum()), 2),
+            "computed_total": round(float(np.nansum(computed[keep])), 2),
+            "total_uah": round(float(total[keep].sum()), 2) if currency == "UAH" else None,
+        }
+
+
+def extract_cost_table(doc) -> dict | None:
+    """Read estimate line items (name, unit, quantity, unit price, total) from
+    the ruled tables of an open PDF.
+
+    Tables that continue on later pages without a header reuse the last
+    header with the same column count. Returns columnar arrays and totals, or
+    None if no line items were found.
+    """
+    builder = CostTableBuilder()
+    header = None
+    for page_index in range(min(len(doc), TABLE_MAX_PAGES)):
+        for table in doc[page_index].find_tables().tables:
+            rows = table.extract()
+            columns, start = _table_header(rows)
+            if columns is not None:
+                header = (columns, table.col_count, _table_units(rows, columns, start))
+            elif header is not None and header[1] == table.col_count:
+                columns, start = header[0], 0
+            else:
+                continue
+            builder.add_rows(rows[start:], columns, page_index + 1, header[2])
+    return builder.result()
+
+
+# ---------------------------------------------------------------------------
+# Currency normalization
+# ---------------------------------------------------------------------------
+
+# Official NBU rates (UAH per unit) come from a CSV shipped next to the
+# handler: date,currency,rate with ISO dates. update_fx_rates.py refreshes
+# it at build time; nothing is fetched at runtime. Amounts convert at the
+# latest rate on or before the analysis date.
+FX_RATES_PATH = os.environ.get("FX_RATES_PATH", str(Path(__file__).with_name("nbu_rates.csv")))
+FX_STALE_DAYS = 45
+
+
+class FxTable:
+    """Dated exchange rates per currency, looked up by binary search."""
+
+    def __init__(self, rows):
+        import numpy as np
+
+        by_currency = {}
+        for day, currency, rate in rows:
+            by_currency.setdefault(currency, []).append((day, rate))
+        self._rates = {}
+        for currency, points in by_currency.items():
+            points.sort()
+            self._rates[currency] = (
+                np.array([day for day, _ in points], dtype="datetime64[D]"),
+                np.array([rate for _, rate in points], dtype=float),
+            )
+
+    @classmethod
+    def from_csv(cls, path: str) -> "FxTable":
+        with open(path, newline="", encoding="utf-8") as f:
+            return cls((row["date"], row["currency"].upper(), float(row["rate"])) for row in csv.DictReader(f))
+
+    def rates(self, currencies, on: date) -> tuple:
+        """(UAH per unit for each currency, date of the oldest rate used);
+        UAH is 1. Raises KeyError when a currency has no rate on or before `on`."""
+        import numpy as np
+
+        day = np.datetime64(on, "D")
+        values = np.ones(len(currencies))
+        oldest = day
+        for i, currency in enumerate(currencies):
+            if currency == "UAH":
+                continue
+            days, rates = self._rates.get(currency, (np.array([], dtype="datetime64[D]"), None))
+            index = np.searchsorted(days, day, side="right") - 1
+            if index < 0:
+                raise KeyError(f"no {currency} rate on or before {on}")
+            values[i] = rates[index]
+            oldest = min(oldest, days[index])
+        return values, oldest.astype(object)
+
+
+_fx_table = None
+_fx_table_loaded = False
+_fx_table_lock = threading.Lock()
+
+
+def fx_table() -> FxTable | None:
+    """The rate table, loaded by the first caller; concurrent workers wait
+    for that load instead of each reading the CSV."""
+    global _fx_table, _fx_table_loaded
+    with _fx_table_lock:
+        if not _fx_table_loaded:
+            if os.path.exists(FX_RATES_PATH):
+                _fx_table = FxTable.from_csv(FX_RATES_PATH)
+            else:
+                logger.warning(f"No FX rates at {FX_RATES_PATH}; USD equivalents are disabled")
+            _fx_table_loaded = True
+        return _fx_table
+
+
+def normalize_cost_signals(cost_signals: dict, on: date) -> dict:
+    """cost_signals plus USD equivalents at NBU rates as of `on`.
+
+    Adds value_usd to each listed amount, usd to each by_currency entry, and
+    total_usd_equivalent: total_uah (which a cost table total may have
+    replaced) plus the USD and EUR amounts, all in USD. Without a rate table
+    these are None.
+    """
+    import numpy as np
+
+    normalized = dict(cost_signals)
+    normalized["amounts"] = [dict(a) for a in cost_signals["amounts"]]
+    normalized["by_currency"] = {c: dict(v) for c, v in cost_signals.get("by_currency", {}).items()}
+    normalized["total_usd_equivalent"] = None
+    normalized["fx"] = None
+
+    table = fx_table()
+    if table is None:
+        return normalized
+    try:
+        per_currency, rate_date = table.rates(CURRENCIES, on)
+    except KeyError as e:
+        logger.warning(f"FX conversion skipped: {e}")
+        return normalized
+    if (on - rate_date).days > FX_STALE_DAYS:
+        logger.warning(f"FX rates in {FX_RATES_PATH} end at {rate_date}")
+    to_usd = per_currency / per_currency[CURRENCIES.index("USD")]
+
+    # One vectorized pass over the listed amounts and the per-currency sums
+    amounts = normalized["amounts"]
+    codes = np.array([CURRENCIES.index(a["currency"]) for a in amounts], dtype=int)
+    values = np.array([a["value"] for a in amounts], dtype=float)
+    for amount, usd in zip(amounts, (values * to_usd[codes]).round(2).tolist()):
+        amount["value_usd"] = usd
+    if normalized["max_amount"] is not None:
+        max_amount = normalized["max_amount"]
+        normalized["max_amount"] = {**max_amount, "value_usd": round(max_amount["value"] * float(to_usd[CURRENCIES.index(max_amount["currency"])]), 2)}
+
+    sums = np.zeros(len(CURRENCIES))
+    for currency, aggregate in normalized["by_currency"].items():
+        sums[CURRENCIES.index(currency)] = aggregate["sum"]
+        aggregate["usd"] = round(aggregate["sum"] * float(to_usd[CURRENCIES.index(currency)]), 2)
+    sums[CURRENCIES.index("UAH")] = cost_signals["total_uah"]
+    normalized["total_usd_equivalent"] = round(float(sums @ to_usd), 2)
+    normalized["fx"] = {
+        "source": "NBU",
+        "date": rate_date.isoformat(),
+        **{f"{c.lower()}_uah": float(per_currency[i]) for i, c in enumerate(CURRENCIES) if c != "UAH"},
     }
+    return normalized
 
 
 # ---------------------------------------------------------------------------
 # Project info extraction
 # ---------------------------------------------------------------------------
 
+_LOCATION_RE = re.compile(
+    r'(?:Дніпропетровськ\w+\s+обл[.,]?\s*,?\s*(?:м\.|с\.)\s*\w+|'
+    r'Україна,\s*[\w\s]+обл[.,]\s*,?\s*(?:м\.|с\.)\s*[\w\s]+)'
+)
+_POWER_RE = re.compile(r'(\d+[\d.,]*)\s*кВт')
+
+
 def extract_project_info(s3_key: str, text: str) -> dict:
     """Extract structured project info from text content."""
     info = {
@@ -175,16 +1594,12 @@ def extract_project_info(s3_key: str, text: str) -> dict:
         info["project_name"] = parts[1]
 
     # Location patterns
-    location_match = re.search(
-        r'(?:Дніпропетровськ\w+\s+обл[.,]?\s*,?\s*(?:м\.|с\.)\s*\w+|'
-        r'Україна,\s*[\w\s]+обл[.,]\s*,?\s*(?:м\.|с\.)\s*[\w\s]+)',
-        text[:3000]
-    )
+    location_match = _LOCATION_RE.search(text[:3000])
     if location_match:
         info["location"] = location_match.group(0).strip()
 
     # Power (kW)
-    power_match = re.search(r'(\d+[\d.,]*)\s*кВт', text[:5000])
+    power_match = _POWER_RE.search(text[:5000])
     if power_match:
         info["power_kw"] = power_match.group(1)
 
@@ -195,126 +1610,754 @@ def extract_project_info(s3_key: str, text: str) -> dict:
 # Verification checklist (based on Hromada Verification Framework)
 # ---------------------------------------------------------------------------
 
+# Each item's "rule" declares how it is checked; compile_rule() turns it into
+# a predicate once at import. Rule kinds:
+#   folder_type  passed when a document of that type is in the project folder
+#   field        passed when project_info[field] is set (the value is the evidence)
+#   currency     passed when any extracted amount is in that currency
+#   keywords     any keyword in the lowercased text (first `scope` chars, or all)
+#   pattern      regex over the original text; the match is the evidence
+# Text rules share one TextViews per document, so each lowercased view is
+# built once however many items read it.
 VERIFICATION_CHECKLIST = [
     {
         "id": "cost_estimate",
         "label": "Cost estimate (кошторис) provided",
         "description": "Detailed cost breakdown from licensed estimator using AVK-5 or equivalent",
+        "rule": {
+            "folder_type": "cost_estimate",
+            "found": "Found cost estimate document",
+            "missing": "No cost estimate in project folder",
+        },
     },
     {
         "id": "design_package",
         "label": "Design/engineering package (РП) provided",
         "description": "Full technical design documentation for the project",
+        "rule": {
+            "folder_type": "design_package",
+            "found": "Found design package",
+            "missing": "No design package in project folder",
+        },
     },
     {
         "id": "technical_report",
         "label": "Technical inspection report provided",
         "description": "Structural/condition assessment by qualified engineer",
+        "rule": {
+            "folder_type": "technical_report",
+            "found": "Found technical report",
+            "missing": "No technical report in project folder",
+        },
     },
     {
         "id": "project_verification",
         "label": "Project verification summary (PV) provided",
         "description": "Partner-level project summary with scope, cost, and co-financing details",
+        "rule": {
+            "folder_type": "project_verification",
+            "found": "Found PV summary",
+            "missing": "No project verification summary",
+        },
     },
     {
         "id": "avk5_software",
         "label": "Cost estimate generated by AVK-5",
         "description": "Standard Ukrainian construction estimating software — indicates professional preparation",
+        "rule": {
+            "keywords": ["авк"],
+            "scope": 5000,
+            "found": "AVK-5 reference found",
+            "missing": "No AVK-5 reference detected",
+        },
     },
     {
         "id": "location_identified",
         "label": "Project location clearly identified",
         "description": "Specific address or location referenced in documents",
+        "rule": {
+            "field": "location",
+            "missing": "No location found",
+        },
     },
     {
         "id": "facility_identified",
         "label": "Target facility/object clearly identified",
         "description": "The building or infrastructure being improved is named",
+        "rule": {
+            "keywords": ["лікарня", "школа", "вежі", "вежа", "насосн", "котельн", "водонапірн"],
+            "scope": 3000,
+            "found": "Facility type keyword found",
+            "missing": "No facility keyword detected",
+        },
     },
     {
         "id": "usd_cost_available",
         "label": "USD cost estimate available",
         "description": "Cost translated to USD for donor communication",
+        "rule": {
+            "currency": "USD",
+            "found": "USD amount found",
+            "missing": "Only UAH amounts detected",
+        },
     },
     {
         "id": "cofinancing_stated",
         "label": "Co-financing commitment stated",
         "description": "Municipality or partner co-financing percentage declared",
+        "rule": {
+            "keywords": ["співфінанс", "co-financ", "cofinanc"],
+            "scope": None,
+            "found": "Co-financing reference found",
+            "missing": "No co-financing reference",
+        },
     },
     {
         "id": "engineer_identified",
         "label": "Preparing engineer/firm identified",
         "description": "Named professional or firm who prepared the technical documents",
+        "rule": {
+            # ФОП (sole proprietor) followed by the name
+            "pattern": r'ФОП\s+[\w\s.]+',
+            "scope": 3000,
+            "missing": "No engineer/firm identified",
+        },
     },
 ]
 
 
+class TextViews:
+    """Normalized views of one document's text, each computed on first use."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self._lower = {}  # scope (None = full text) -> lowercased text
+
+    def original(self, scope: int | None) -> str:
+        return self.text if scope is None else self.text[:scope]
+
+    def lower(self, scope: int | None) -> str:
+        view = self._lower.get(scope)
+        if view is None:
+            view = self._lower[scope] = self.original(scope).lower()
+        return view
+
+
+class VerificationInput:
+    """Everything a compiled rule may read for one document."""
+
+    def __init__(self, text: str, cost_signals: dict, project_info: dict, doc_types):
+        self.views = TextViews(text)
+        self.cost_signals = cost_signals
+        self.project_info = project_info
+        self.doc_types = frozenset(doc_types)
+
+
+def compile_rule(rule: dict):
+    """Turn a declarative rule into check(VerificationInput) -> (passed, evidence)."""
+    found, missing = rule.get("found"), rule["missing"]
+
+    if "folder_type" in rule:
+        doc_type = rule["folder_type"]
+
+        def check(inp):
+            passed = doc_type in inp.doc_types
+            return passed, found if passed else missing
+
+    elif "field" in rule:
+        field = rule["field"]
+
+        def check(inp):
+            return inp.project_info.get(field) is not None, inp.project_info.get(field, missing)
+
+    elif "currency" in rule:
+        currency = rule["currency"]
+
+        def check(inp):
+            max_amt = inp.cost_signals.get("max_amount")
+            passed = (max_amt is not None and max_amt.get("currency") == currency) or any(
+                a["currency"] == currency for a in inp.cost_signals.get("amounts", [])
+            )
+            return passed, found if passed else missing
+
+    elif "keywords" in rule:
+        # One alternation instead of a scan per keyword; search() stops at
+        # the first hit
+        keywords = re.compile("|".join(re.escape(kw.lower()) for kw in rule["keywords"]))
+        scope = rule.get("scope")
+
+        def check(inp):
+            passed = keywords.search(inp.views.lower(scope)) is not None
+            return passed, found if passed else missing
+
+    elif "pattern" in rule:
+        pattern = re.compile(rule["pattern"])
+        scope = rule.get("scope")
+
+        def check(inp):
+            match = pattern.search(inp.views.original(scope))
+            if match:
+                return True, match.group(0).strip()
+            return False, missing
+
+    else:
+        raise ValueError(f"Unknown verification rule: {rule}")
+    return check
+
+
+VERIFICATION_RULES = [(item, compile_rule(item["rule"])) for item in VERIFICATION_CHECKLIST]
+VERIFICATION_RULE_SPECS = {item["id"]: item["rule"] for item in VERIFICATION_CHECKLIST}
+
+
 def run_verification(s3_key: str, parsed: dict, classification: str, cost_signals: dict, project_info: dict, all_project_docs: list) -> dict:
     """Score the document against the verification checklist.
 
     all_project_docs is a list of classifications for ALL docs in the same project folder.
     """
-    text = parsed.get("full_text", "")
+    inp = VerificationInput(parsed.get("full_text", ""), cost_signals, project_info, all_project_docs)
     results = []
 
-    for item in VERIFICATION_CHECKLIST:
-        passed = False
-        evidence = ""
+    for item, check in VERIFICATION_RULES:
+        passed, evidence = check(inp)
+        results.append({
+            "id": item["id"],
+            "label": item["label"],
+            "description": item["description"],
+            "passed": passed,
+            "evidence": evidence,
+        })
 
-        if item["id"] == "cost_estimate":
-            passed = "cost_estimate" in all_project_docs
-            evidence = "Found cost estimate document" if passed else "No cost estimate in project folder"
+    passed_count = sum(1 for r in results if r["passed"])
+    return {
+        "score": f"{passed_count}/{len(results)}",
+        "passed": passed_count,
+        "total": len(results),
+        "percentage": round(passed_count / len(results) * 100, 1),
+        "items": results,
+    }
 
-        elif item["id"] == "design_package":
-            passed = "design_package" in all_project_docs
-            evidence = "Found design package" if passed else "No design package in project folder"
 
-        elif item["id"] == "technical_report":
-            passed = "technical_report" in all_project_docs
-            evidence = "Found technical report" if passed else "No technical report in project folder"
+# ---------------------------------------------------------------------------
+# Page hit index
+# ---------------------------------------------------------------------------
 
-        elif item["id"] == "project_verification":
-            passed = "project_verification" in all_project_docs
-            evidence = "Found PV summary" if passed else "No project verification summary"
+# HIT_INDEX=1 (the default) writes a <name>.hits.json sidecar next to each
+# analysis: where in the document every cost amount, the classification
+# keyword and the text evidence of each checklist item occur, so review
+# tooling can open the right page without re-extracting. Each group keeps at
+# most HIT_INDEX_MAX_HITS hits.
+HIT_INDEX = os.environ.get("HIT_INDEX", "1") == "1"
+HIT_INDEX_MAX_HITS = int(os.environ.get("HIT_INDEX_MAX_HITS", 2000))
 
-        elif item["id"] == "avk5_software":
-            passed = "авк" in text[:5000].lower() or "авк-5" in text[:5000].lower()
-            evidence = "AVK-5 reference found" if passed else "No AVK-5 reference detected"
 
-        elif item["id"] == "location_identified":
-            passed = project_info.get("location") is not None
-            evidence = project_info.get("location", "No location found")
+def compile_locator(rule: dict):
+    """(regex, scope) finding every occurrence a text rule would match, or
+    None for rules that don't read the text."""
+    if "keywords" in rule:
+        keywords = "|".join(re.escape(kw) for kw in rule["keywords"])
+        return re.compile(keywords, re.IGNORECASE), rule.get("scope")
+    if "pattern" in rule:
+        return re.compile(rule["pattern"]), rule.get("scope")
+    return None
 
-        elif item["id"] == "facility_identified":
-            passed = any(kw in text[:3000].lower() for kw in ["лікарня", "школа", "вежі", "вежа", "насосн", "котельн", "водонапірн"])
-            evidence = "Facility type keyword found" if passed else "No facility keyword detected"
 
-        elif item["id"] == "usd_cost_available":
-            max_amt = cost_signals.get("max_amount")
-            passed = (max_amt is not None and max_amt.get("currency") == "USD") or any(
-                a["currency"] == "USD" for a in cost_signals.get("amounts", [])
-            )
-            evidence = "USD amount found" if passed else "Only UAH amounts detected"
-
-        elif item["id"] == "cofinancing_stated":
-            passed = "співфінанс" in text.lower() or "co-financ" in text.lower() or "cofinanc" in text.lower()
-            evidence = "Co-financing reference found" if passed else "No co-financing reference"
-
-        elif item["id"] == "engineer_identified":
-            # Look for ФОП (sole proprietor) or company names
-            fop_match = re.search(r'ФОП\s+[\w\s.]+', text[:3000])
-            if fop_match:
-                passed = True
-                evidence = fop_match.group(0).strip()
-            else:
-                evidence = "No engineer/firm identified"
+CHECK_LOCATORS = {
+    item["id"]: locator
+    for item in VERIFICATION_CHECKLIST
+    if (locator := compile_locator(item["rule"])) is not None
+}
 
-        results.append({
-            **item,
-            "passed": passed,
-            "evidence": evidence,
+
+class PageLocator:
+    """Maps offsets in full_text to [page, offset within page, length]."""
+
+    def __init__(self, page_starts: list | None):
+        # Cached analyses from before page_starts existed count as one page
+        self.pages = [page for page, _ in page_starts] if page_starts else [1]
+        self.starts = [start for _, start in page_starts] if page_starts else [0]
+
+    def locate(self, start: int, end: int) -> list:
+        i = max(bisect.bisect_right(self.starts, start) - 1, 0)
+        return [self.pages[i], start - self.starts[i], end - start]
+
+
+def cost_amount_spans(scanned: list) -> list:
+    """(start, end, currency, value) of the amounts extract_cost_signals counts."""
+    return [(start, end, currency, value) for value, currency, start, end in scanned if value > 100]
+
+
+def build_hit_index(analysis: dict, parsed: dict, project_info: dict, amount_spans: list = None) -> dict:
+    """Hit locations for one document. Hits are [page, offset, length]
+    (offset within that page's extracted text); cost hits add currency and
+    value. amount_spans comes from analyze_file(); the text is scanned again
+    only without it (cache entries written before it was stored)."""
+    text = parsed.get("full_text", "")
+    locator = PageLocator(parsed.get("page_starts"))
+    truncated = []
+
+    def capped(name, hits):
+        if len(hits) > HIT_INDEX_MAX_HITS:
+            truncated.append(name)
+            return hits[:HIT_INDEX_MAX_HITS]
+        return hits
+
+    # Every amount extract_cost_signals counts, before deduplication
+    if amount_spans is None:
+        amount_spans = cost_amount_spans(scan_currency_amounts(text))
+    amounts = sorted(amount_spans)
+    cost_hits = [locator.locate(start, end) + [currency, value] for start, end, currency, value in amounts]
+
+    classification = None
+    rule = analysis["classification_rule"]
+    if rule:
+        pattern = re.compile(re.escape(rule["pattern"]), re.IGNORECASE)
+        classification = {
+            **rule,
+            "hits": capped("classification", [locator.locate(*m.span()) for m in pattern.finditer(text)]),
+        }
+
+    checks = {}
+    for item in analysis["verification"]["items"]:
+        if not item["passed"]:
+            continue
+        if item["id"] in CHECK_LOCATORS:
+            regex, scope = CHECK_LOCATORS[item["id"]]
+            spans = [m.span() for m in regex.finditer(text if scope is None else text[:scope])]
+        elif "field" in VERIFICATION_RULE_SPECS[item["id"]]:
+            value = project_info.get(VERIFICATION_RULE_SPECS[item["id"]]["field"])
+            spans = [m.span() for m in re.finditer(re.escape(value), text)] if value else []
+        else:
+            continue
+        if spans:
+            checks[item["id"]] = capped(item["id"], [locator.locate(start, end) for start, end in spans])
+
+    return {
+        "s3_key": analysis["s3_key"],
+        "analyzer_version": ANALYZER_VERSION,
+        "text_length": len(text),
+        "text_complete": parsed.get("text_complete", True),
+        "pages": parsed.get("page_starts") or [[1, 0]],
+        "cost_signals": capped("cost_signals", cost_hits),
+        "classification": classification,
+        "checks": checks,
+        "truncated": truncated,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Result cache (content-addressed)
+# ---------------------------------------------------------------------------
+
+# Changes whenever this file changes, so cached results never outlive the
+# extraction/checklist code that produced them. Each version caches under its
+# own prefix, so every deploy orphans the previous one: prune() deletes the
+# prefixes of other versions once nothing has been written to them for
+# RESULT_CACHE_RETENTION_DAYS (deploy.sh runs it, as handler.py --prune-cache).
+# The wait keeps a version another deployment or a backfill still runs.
+ANALYZER_VERSION = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:12]
+
+# "s3" caches under RESULTS_PREFIX in the results bucket, "off" disables the
+# cache, anything else is a local directory (for tests and local runs).
+# A hit saves the download and the parse only; the document's listings,
+# result writes and rollups still run (about a dozen requests, 50 more with
+# DUPLICATE_INDEX).
+RESULT_CACHE = os.environ.get("RESULT_CACHE", "s3")
+RESULT_CACHE_RETENTION_DAYS = int(os.environ.get("RESULT_CACHE_RETENTION_DAYS", 30))
+
+
+def content_digest(head: dict) -> str:
+    """Cache key for an object from its HEAD response: the SHA-256 checksum
+    when S3 has one, the ETag otherwise."""
+    checksum = head.get("ChecksumSHA256")
+    if checksum:
+        return "sha256-" + checksum.replace("/", "_").replace("+", "-").rstrip("=")
+    return "etag-" + head["ETag"].strip('"')
+
+
+class LocalResultCache:
+    def __init__(self, root: str):
+        self.root = Path(root) / ANALYZER_VERSION
+
+    def get(self, digest: str) -> dict | None:
+        path = self.root / f"{digest}.json.gz"
+        if not path.exists():
+            return None
+        return json.loads(gzip.decompress(path.read_bytes()))
+
+    def put(self, digest: str, entry: dict):
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self.root / f"{digest}.json.gz"
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(gzip.compress(json.dumps(entry, ensure_ascii=False).encode()))
+        tmp.replace(path)
+
+    def prune(self, retention_days: int = RESULT_CACHE_RETENTION_DAYS) -> int:
+        """Remove other versions' directories with nothing written in
+        retention_days. Returns the number of entries removed."""
+        cutoff = time.time() - retention_days * 86400
+        removed = 0
+        for version in self.root.parent.iterdir() if self.root.parent.exists() else ():
+            if version == self.root or not version.is_dir():
+                continue
+            entries = list(version.iterdir())
+            if any(entry.stat().st_mtime >= cutoff for entry in entries):
+                continue
+            shutil.rmtree(version)
+            removed += len(entries)
+            logger.info(f"Pruned {len(entries)} cache entries under {version}")
+        return removed
+
+
+class S3ResultCache:
+    def __init__(self, bucket: str = RESULTS_BUCKET, prefix: str = RESULTS_PREFIX + "_cache/"):
+        self.bucket = bucket
+        self.root = prefix
+        self.prefix = f"{prefix}{ANALYZER_VERSION}/"
+
+    def get(self, digest: str) -> dict | None:
+        try:
+            response = s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}{digest}.json.gz")
+        except s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(gzip.decompress(response["Body"].read()))
+
+    def put(self, digest: str, entry: dict):
+        s3.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{digest}.json.gz",
+            Body=gzip.compress(json.dumps(entry, ensure_ascii=False).encode()),
+            ContentType="application/gzip",
+        )
+
+    def prune(self, retention_days: int = RESULT_CACHE_RETENTION_DAYS) -> int:
+        """Delete other versions' prefixes with nothing written in
+        retention_days. Returns the number of entries deleted."""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+        paginator = s3.get_paginator("list_objects_v2")
+        deleted = 0
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.root, Delimiter="/"):
+            for common in page.get("CommonPrefixes", []):
+                prefix = common["Prefix"]
+                if prefix == self.prefix:
+                    continue
+                objects = [obj for listing in paginator.paginate(Bucket=self.bucket, Prefix=prefix)
+                           for obj in listing.get("Contents", [])]
+                if any(obj["LastModified"] >= cutoff for obj in objects):
+                    continue
+                for i in range(0, len(objects), 1000):  # DeleteObjects limit
+                    s3.delete_objects(Bucket=self.bucket, Delete={
+                        "Objects": [{"Key": obj["Key"]} for obj in objects[i:i + 1000]], "Quiet": True,
+                    })
+                deleted += len(objects)
+                logger.info(f"Pruned {len(objects)} cache entries under s3://{self.bucket}/{prefix}")
+        return deleted
+
+
+def make_result_cache(spec: str = RESULT_CACHE):
+    if spec == "off":
+        return None
+    if spec == "s3":
+        return S3ResultCache()
+    return LocalResultCache(spec)
+
+
+# ---------------------------------------------------------------------------
+# Result objects
+# ---------------------------------------------------------------------------
+
+# OUTPUT_FORMAT=compact writes analyses without indentation and with the bulky
+# fields trimmed (see compact_analysis). OUTPUT_FIELDS (comma-separated)
+# projects analyses down to the listed top-level fields. OUTPUT_ENCODING
+# (gzip or zstd) compresses every result object and sets Content-Encoding.
+# A bad OUTPUT_ENCODING fails at import rather than after each analysis,
+# where SQS would retry the document forever.
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "pretty")
+OUTPUT_FIELDS = [f.strip() for f in os.environ.get("OUTPUT_FIELDS", "").split(",") if f.strip()]
+OUTPUT_ENCODING = os.environ.get("OUTPUT_ENCODING", "")
+if OUTPUT_ENCODING not in ("", "gzip", "zstd"):
+    raise RuntimeError(f"OUTPUT_ENCODING must be gzip, zstd or empty, not {OUTPUT_ENCODING!r}")
+if OUTPUT_ENCODING == "zstd" and importlib.util.find_spec("zstandard") is None:
+    raise RuntimeError("OUTPUT_ENCODING=zstd needs the zstandard package (see requirements.txt)")
+COMPACT_SCHEMA_VERSION = 1
+COMPACT_PREVIEW_CHARS = 500
+RESULT_WRITE_RETRIES = 5
+
+# Striped by key hash, so the lock table stays fixed however many keys a
+# long backfill touches; keys sharing a stripe just take turns. update()
+# callbacks must not update other objects, or two stripes could deadlock.
+_UPDATE_LOCK_STRIPES = 64
+_update_locks = [threading.Lock() for _ in range(_UPDATE_LOCK_STRIPES)]
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd result encoding needs the zstandard package") from None
+    return zstandard
+
+
+def encode_body(data: bytes, encoding: str = OUTPUT_ENCODING) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(data)
+    if encoding == "zstd":
+        return _zstandard().ZstdCompressor().compress(data)
+    return data
+
+
+def decode_body(data: bytes, encoding: str | None) -> bytes:
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    if encoding == "zstd":
+        return _zstandard().ZstdDecompressor().decompress(data)
+    return data
+
+
+def put_result(key: str, data: bytes, content_type: str, encoding: str | None = None, **extra) -> dict:
+    """Write a result object. encoding defaults to OUTPUT_ENCODING; pass ""
+    for formats that are already compressed."""
+    encoding = OUTPUT_ENCODING if encoding is None else encoding
+    params = {"ContentType": content_type, **extra}
+    if encoding:
+        params["ContentEncoding"] = encoding
+    return s3.put_object(Bucket=RESULTS_BUCKET, Key=key, Body=encode_body(data, encoding), **params)
+
+
+def read_result(key: str) -> tuple:
+    """Return (decoded body, etag) of a result object; (None, None) if missing."""
+    try:
+        response = s3.get_object(Bucket=RESULTS_BUCKET, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return None, None
+    return decode_body(response["Body"].read(), response.get("ContentEncoding")), response["ETag"]
+
+
+def update_result_object(key: str, update, content_type: str, encoding: str | None = None):
+    """Read-modify-write of a small shared object in the results bucket.
+
+    update(current_body_or_None) returns (new_body, value); value is returned
+    once the write lands. Threads in this process take turns per key; across
+    processes, writes are conditional on the ETag that was read, so concurrent
+    updates retry instead of overwriting each other.
+    """
+    with _update_locks[zlib.crc32(key.encode("utf-8")) % _UPDATE_LOCK_STRIPES]:
+        for _ in range(RESULT_WRITE_RETRIES):
+            body, etag = read_result(key)
+            new_body, value = update(body)
+            condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+            try:
+                put_result(key, new_body, content_type, encoding, **condition)
+                return value
+            except s3.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                    raise
+                logger.info(f"{key} changed concurrently, retrying")
+
+    raise RuntimeError(f"Could not update {key} after {RESULT_WRITE_RETRIES} attempts")
+
+
+# Objects summarizing a whole partner (its index, corpus file and search
+# database) are not rewritten per document, which would cost O(documents)
+# per write and O(documents²) per partner. Each invocation, or every
+# PARTS_FLUSH_DOCS documents of a backfill, writes its batch as a small part
+# file next to the object; compaction folds the pending parts in with one
+# rewrite. A backfill compacts the partners it touched when it ends; run
+# it periodically for documents the Lambda analyzed:
+#
+#     python handler.py --compact [partner]
+PARTS_FLUSH_DOCS = int(os.environ.get("PARTS_FLUSH_DOCS", 500))
+
+
+def part_key(prefix: str, suffix: str) -> str:
+    """A new part file's key. Keys sort in write order and never collide,
+    so a part is never overwritten and compaction applies them oldest first."""
+    return f"{prefix}{time.time_ns():020d}-{os.urandom(4).hex()}{suffix}"
+
+
+def list_parts(prefix: str) -> list:
+    paginator = s3.get_paginator("list_objects_v2")
+    return [
+        obj["Key"]
+        for page in paginator.paginate(Bucket=RESULTS_BUCKET, Prefix=prefix)
+        for obj in page.get("Contents", [])
+    ]
+
+
+def delete_parts(keys: list):
+    for i in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=RESULTS_BUCKET, Delete={
+            "Objects": [{"Key": key} for key in keys[i:i + 1000]], "Quiet": True,
         })
 
+
+def compact_parts(key: str, prefix: str, merge, content_type: str, encoding: str | None = None) -> int:
+    """Fold the part files under prefix into the object at key, then delete
+    them. Returns the number of parts merged.
+
+    merge(current_body_or_None, part_bodies) returns the new body, with
+    parts oldest first. The write goes through update_result_object(), so a
+    concurrent compaction makes this one merge again; parts written after
+    the listing stay for the next run.
+    """
+    keys = list_parts(prefix)
+    if not keys:
+        return 0
+    # A part missing here was merged and deleted by a concurrent compaction
+    parts = [body for body, _ in map(read_result, keys) if body is not None]
+    update_result_object(key, lambda body: (merge(body, parts), None), content_type, encoding)
+    delete_parts(keys)
+    logger.info(f"Compacted {len(keys)} parts -> s3://{RESULTS_BUCKET}/{key}")
+    return len(keys)
+
+
+def compact_analysis(analysis: dict) -> dict:
+    """Versioned compact form: short preview, sibling count instead of the
+    sibling list, [value, currency] pairs instead of raw amount strings, and
+    checklist items without their static label/description."""
+    doc = dict(analysis)
+    doc["schema_version"] = COMPACT_SCHEMA_VERSION
+    doc["text_preview"] = analysis["text_preview"][:COMPACT_PREVIEW_CHARS]
+    doc["sibling_count"] = len(doc.pop("sibling_docs"))
+
+    cost_signals = dict(analysis["cost_signals"])
+    cost_signals["amounts"] = [[a["value"], a["currency"]] for a in cost_signals["amounts"]]
+    max_amount = cost_signals["max_amount"]
+    cost_signals["max_amount"] = [max_amount["value"], max_amount["currency"]] if max_amount else None
+    doc["cost_signals"] = cost_signals
+
+    verification = dict(analysis["verification"])
+    verification["items"] = [
+        {"id": item["id"], "passed": item["passed"], "evidence": item["evidence"]}
+        for item in verification["items"]
+    ]
+    doc["verification"] = verification
+    return doc
+
+
+def render_analysis(analysis: dict) -> bytes:
+    if OUTPUT_FORMAT == "compact":
+        doc = compact_analysis(analysis)
+    else:
+        doc = analysis
+    if OUTPUT_FIELDS:
+        doc = {k: v for k, v in doc.items() if k in OUTPUT_FIELDS or k == "s3_key"}
+    if OUTPUT_FORMAT == "compact":
+        return json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode()
+    return json.dumps(doc, ensure_ascii=False, indent=2).encode()
+
+
+def partner_index_key(s3_key: str) -> str:
+    return RESULTS_PREFIX + s3_key.split("/")[0] + "/index.ndjson"
+
+
+def partner_index_parts_prefix(partner: str) -> str:
+    return f"{RESULTS_PREFIX}{partner}/_index/"
+
+
+def index_entry(analysis: dict) -> dict:
+    return {
+        "key": analysis["s3_key"],
+        "classification": analysis["classification"],
+        "analyzed_at": analysis["analyzed_at"],
+        "verification_score": analysis["verification"]["score"],
+        "verification_percentage": analysis["verification"]["percentage"],
+        "cost_signals": analysis["cost_signals"]["count"],
+        "total_uah": analysis["cost_signals"]["total_uah"],
+        "total_usd_equivalent": analysis["cost_signals"].get("total_usd_equivalent"),
+        "page_count": analysis["page_count"],
+        "content_digest": analysis.get("content_digest"),
+        "duplicate_of": (analysis.get("duplicate_of") or {}).get("s3_key"),
+    }
+
+
+def index_ndjson(entries: dict) -> bytes:
+    lines = [json.dumps(entries[k], ensure_ascii=False) for k in sorted(entries)]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def merge_partner_index(body: bytes | None, parts: list) -> bytes:
+    """_analysis/<partner>/index.ndjson with the parts' summary lines
+    upserted, so a partner's status is one GET instead of one per document."""
+    entries = {}
+    for chunk in [body, *parts]:
+        for line in (chunk or b"").decode("utf-8").splitlines():
+            if line:
+                entry = json.loads(line)
+                entries[entry["key"]] = entry
+    return index_ndjson(entries)
+
+
+# ---------------------------------------------------------------------------
+# Project rollups
+# ---------------------------------------------------------------------------
+
+# Checklist items that are properties of the project folder: passed when any
+# document in the folder (or at the partner root) has the given type.
+FOLDER_CHECKS = {
+    item["id"]: item["rule"]["folder_type"]
+    for item in VERIFICATION_CHECKLIST
+    if "folder_type" in item["rule"]
+}
+
+
+def rollup_key(s3_key: str) -> str:
+    """_analysis/<partner>/<project>/project.json for documents in a project
+    folder, _analysis/<partner>/project.json for documents at the partner root."""
+    parts = s3_key.split("/")
+    folder = parts[:2] if len(parts) > 2 else parts[:1]
+    return RESULTS_PREFIX + "/".join(folder) + "/project.json"
+
+
+def rollup_document_entry(analysis: dict) -> dict:
+    return {
+        "classification": analysis["classification"],
+        "analyzed_at": analysis["analyzed_at"],
+        "content_digest": analysis.get("content_digest"),
+        "cost_signals": analysis["cost_signals"]["count"],
+        "total_uah": analysis["cost_signals"]["total_uah"],
+        "duplicate_of": (analysis.get("duplicate_of") or {}).get("s3_key"),
+        # Evidence for the document-level checks this document passed
+        "checks": {
+            item["id"]: item["evidence"]
+            for item in analysis["verification"]["items"]
+            if item["passed"] and item["id"] not in FOLDER_CHECKS
+        },
+    }
+
+
+def rollup_total_uah(documents: dict) -> float:
+    """Sum of document totals, counting a near-duplicate only when the
+    document it copies is not in the same rollup."""
+    total = 0
+    for key, doc in documents.items():
+        original = doc.get("duplicate_of")
+        if original in documents and documents[original].get("duplicate_of") != key:
+            continue
+        total += doc["total_uah"]
+    return total
+
+
+def rollup_verification(documents: dict, inherited_doc_types: dict) -> dict:
+    """Project-level checklist from per-document rollup entries.
+
+    inherited_doc_types maps partner-root document keys to their types; they
+    count towards the folder checks like they do in run_verification.
+    """
+    doc_types = {key: doc["classification"] for key, doc in documents.items()}
+    doc_types.update(inherited_doc_types)
+
+    results = []
+    for item in VERIFICATION_CHECKLIST:
+        if item["id"] in FOLDER_CHECKS:
+            matches = sorted(k for k, t in doc_types.items() if t == FOLDER_CHECKS[item["id"]])
+            passed = bool(matches)
+            evidence = matches
+        else:
+            matches = sorted(k for k, doc in documents.items() if item["id"] in doc["checks"])
+            passed = bool(matches)
+            evidence = [{"key": k, "evidence": documents[k]["checks"][item["id"]]} for k in matches]
+        results.append({"id": item["id"], "label": item["label"], "passed": passed, "evidence": evidence})
+
     passed_count = sum(1 for r in results if r["passed"])
     return {
         "score": f"{passed_count}/{len(results)}",
@@ -325,17 +2368,1187 @@ def run_verification(s3_key: str, parsed: dict, classification: str, cost_signal
     }
 
 
+def _partner_doc_types(partner_key: str) -> dict:
+    """{key: classification} of the documents in a partner-root rollup."""
+    body, _ = read_result(partner_key)
+    if not body:
+        return {}
+    return {k: doc["classification"] for k, doc in json.loads(body)["documents"].items()}
+
+
+def _fold_rollup(body: bytes | None, partner: str, project: str | None, documents: dict) -> tuple:
+    """Apply {s3_key: rollup entry} to a project.json body and refresh its
+    totals and checklist. Project rollups re-read the partner's root
+    documents each time, so a retry after a conflicting write sees the
+    partner rollup as of that write."""
+    if body:
+        rollup = json.loads(body)
+    else:
+        rollup = {"partner": partner, "project": project, "documents": {}}
+    inherited = _partner_doc_types(RESULTS_PREFIX + partner + "/project.json") if project is not None else {}
+    rollup["documents"].update(documents)
+    rollup["updated_at"] = datetime.now(timezone.utc).isoformat()
+    rollup["analyzer_version"] = ANALYZER_VERSION
+    rollup["doc_types"] = sorted({doc["classification"] for doc in rollup["documents"].values()})
+    rollup["total_uah"] = rollup_total_uah(rollup["documents"])
+    rollup["verification"] = rollup_verification(rollup["documents"], inherited)
+    return json.dumps(rollup, ensure_ascii=False).encode("utf-8"), rollup
+
+
+def update_project_rollup(analysis: dict) -> dict:
+    """Fold one document's analysis into its project.json.
+
+    Read-modify-write of a single small object: siblings are neither listed
+    nor re-classified. Partner-root documents (partner-level PVs) are picked
+    up from the partner's own project.json when a project document is
+    folded in. A partner-root document that changes a folder check type
+    re-runs the checklist of every project rollup of the partner.
+    """
+    s3_key = analysis["s3_key"]
+    key = rollup_key(s3_key)
+    parts = s3_key.split("/")
+    partner_key = RESULTS_PREFIX + parts[0] + "/project.json"
+    project = parts[1] if key != partner_key else None
+    previous = None
+
+    def fold(body):
+        nonlocal previous
+        if body:
+            previous = json.loads(body)["documents"].get(s3_key, {}).get("classification")
+        return _fold_rollup(body, parts[0], project, {s3_key: rollup_document_entry(analysis)})
+
+    rollup = update_result_object(key, fold, "application/json")
+    classification = analysis["classification"]
+    if project is None and previous != classification and {previous, classification} & set(FOLDER_CHECKS.values()):
+        refresh_project_rollups(parts[0])
+    return rollup
+
+
+def refresh_project_rollups(partner: str) -> int:
+    """Re-run the checklist of each project rollup of a partner against its
+    current partner-root documents. Returns the number of rollups updated."""
+    prefix = f"{RESULTS_PREFIX}{partner}/"
+    paginator = s3.get_paginator("list_objects_v2")
+    projects = [
+        common["Prefix"][len(prefix):].rstrip("/")
+        for page in paginator.paginate(Bucket=RESULTS_BUCKET, Prefix=prefix, Delimiter="/")
+        for common in page.get("CommonPrefixes", [])
+    ]
+    for project in projects:
+        refold = functools.partial(_fold_rollup, partner=partner, project=project, documents={})
+        update_result_object(f"{prefix}{project}/project.json", refold, "application/json")
+    logger.info(f"Refreshed {len(projects)} project rollups of {partner}")
+    return len(projects)
+
+
+# ---------------------------------------------------------------------------
+# Corpus export (columnar)
+# ---------------------------------------------------------------------------
+
+# CORPUS_EXPORT=1 keeps one flattened row per analysis in a Parquet dataset,
+# one file per partner under _analysis/_corpus/partner=<name>/ (hive layout,
+# so pyarrow.dataset, DuckDB or Athena can prune by partner). Portfolio
+# queries then scan a few column chunks instead of GETting and parsing every
+# .analysis.json. New rows arrive as _part-* files beside the partner's file
+# until compaction merges them (see PARTS_FLUSH_DOCS). pyarrow is only
+# imported when export is used; it is not in requirements.txt because it
+# would triple the Lambda package.
+CORPUS_EXPORT = os.environ.get("CORPUS_EXPORT", "").lower() not in ("", "0", "off")
+CORPUS_PREFIX = RESULTS_PREFIX + "_corpus/"
+CORPUS_READ_WORKERS = 16
+
+CORPUS_COLUMNS = [
+    ("s3_key", "string"),
+    ("partner", "string"),
+    ("project", "string"),
+    ("file_type", "string"),
+    ("classification", "string"),
+    ("classification_pattern", "string"),
+    ("classification_source", "string"),
+    ("location", "string"),
+    ("facility", "string"),
+    ("power_kw", "string"),
+    ("page_count", "int64"),
+    ("text_length", "int64"),
+    ("text_complete", "bool"),
+    ("ocr_pages", "int64"),
+    ("cost_signal_count", "int64"),
+    ("total_uah", "float64"),
+    ("total_uah_source", "string"),
+    ("total_usd_equivalent", "float64"),
+    ("max_amount", "float64"),
+    ("max_amount_currency", "string"),
+    ("cost_table_items", "int64"),
+    ("cost_table_total_uah", "float64"),
+    ("verification_passed", "int64"),
+    ("verification_total", "int64"),
+    ("verification_percentage", "float64"),
+    ("duplicate_of", "string"),
+    ("duplicate_similarity", "float64"),
+] + [("check_" + item["id"], "bool") for item in VERIFICATION_CHECKLIST] + [
+    ("analyzed_at", "string"),
+    ("analyzer_version", "string"),
+    ("content_digest", "string"),
+]
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("corpus export needs the pyarrow package") from None
+    return pyarrow
+
+
+def corpus_schema():
+    pa = _pyarrow()
+    return pa.schema([(name, pa.type_for_alias(kind)) for name, kind in CORPUS_COLUMNS])
+
+
+def corpus_key(partner: str) -> str:
+    return f"{CORPUS_PREFIX}partner={partner}/analyses.parquet"
+
+
+def corpus_parts_prefix(partner: str) -> str:
+    # pyarrow.dataset, Hive and Athena skip files starting with _, so
+    # pending parts never show up as duplicate rows
+    return f"{CORPUS_PREFIX}partner={partner}/_part-"
+
+
+def flatten_analysis(analysis: dict) -> dict:
+    """One corpus row from a stored analysis, pretty or compact. Fields
+    missing from a projected analysis come out as nulls."""
+    parts = analysis["s3_key"].split("/")
+    project_info = analysis.get("project_info") or {}
+    cost_signals = analysis.get("cost_signals") or {}
+    cost_table = analysis.get("cost_table") or {}
+    verification = analysis.get("verification") or {}
+    rule = analysis.get("classification_rule") or {}
+    duplicate = analysis.get("duplicate_of") or {}
+
+    max_amount = cost_signals.get("max_amount")
+    if isinstance(max_amount, list):
+        max_amount = {"value": max_amount[0], "currency": max_amount[1]}
+    checks = {item["id"]: item["passed"] for item in verification.get("items", [])}
+
+    row = {
+        "s3_key": analysis["s3_key"],
+        "partner": parts[0],
+        "project": parts[1] if len(parts) > 2 else None,
+        "file_type": analysis.get("file_type"),
+        "classification": analysis.get("classification"),
+        "classification_pattern": rule.get("pattern"),
+        "classification_source": rule.get("source"),
+        "location": project_info.get("location"),
+        "facility": project_info.get("facility"),
+        "power_kw": project_info.get("power_kw"),
+        "page_count": analysis.get("page_count"),
+        "text_length": analysis.get("text_length"),
+        "text_complete": analysis.get("text_complete"),
+        "ocr_pages": analysis.get("ocr_pages"),
+        "cost_signal_count": cost_signals.get("count"),
+        "total_uah": cost_signals.get("total_uah"),
+        "total_uah_source": cost_signals.get("total_uah_source"),
+        "total_usd_equivalent": cost_signals.get("total_usd_equivalent"),
+        "max_amount": max_amount["value"] if max_amount else None,
+        "max_amount_currency": max_amount["currency"] if max_amount else None,
+        "cost_table_items": cost_table.get("line_items"),
+        "cost_table_total_uah": cost_table.get("total_uah"),
+        "verification_passed": verification.get("passed"),
+        "verification_total": verification.get("total"),
+        "verification_percentage": verification.get("percentage"),
+        "duplicate_of": duplicate.get("s3_key"),
+        "duplicate_similarity": duplicate.get("similarity"),
+        "analyzed_at": analysis.get("analyzed_at"),
+        "analyzer_version": analysis.get("analyzer_version"),
+        "content_digest": analysis.get("content_digest"),
+    }
+    for item in VERIFICATION_CHECKLIST:
+        row["check_" + item["id"]] = checks.get(item["id"])
+    return row
+
+
+def corpus_parquet(rows: list) -> bytes:
+    pa = _pyarrow()
+    table = pa.Table.from_pylist(sorted(rows, key=lambda r: r["s3_key"]), schema=corpus_schema())
+    buffer = io.BytesIO()
+    pa.parquet.write_table(table, buffer, compression="zstd")
+    return buffer.getvalue()
+
+
+def merge_corpus(body: bytes | None, parts: list) -> bytes:
+    """A partner's Parquet file with the parts' rows upserted.
+
+    Rows are re-read through the current schema, so files written before a
+    checklist change pick up the new columns as nulls.
+    """
+    pa = _pyarrow()
+    rows = {}
+    for chunk in [body, *parts]:
+        if chunk:
+            rows.update((r["s3_key"], r) for r in pa.parquet.read_table(io.BytesIO(chunk)).to_pylist())
+    return corpus_parquet(list(rows.values()))
+
+
+def export_corpus(prefix: str = "") -> dict:
+    """Rebuild the corpus from the stored analyses under RESULTS_PREFIX +
+    prefix. Returns row counts per partner."""
+    paginator = s3.get_paginator("list_objects_v2")
+    keys = [
+        obj["Key"]
+        for page in paginator.paginate(Bucket=RESULTS_BUCKET, Prefix=RESULTS_PREFIX + prefix)
+        for obj in page.get("Contents", [])
+        if obj["Key"].endswith(".analysis.json")
+    ]
+
+    def load(key):
+        body, _ = read_result(key)
+        return flatten_analysis(json.loads(body))
+
+    partners = {}
+    with ThreadPoolExecutor(max_workers=CORPUS_READ_WORKERS) as pool:
+        for row in pool.map(load, keys):
+            partners.setdefault(row["partner"], []).append(row)
+
+    for partner, rows in partners.items():
+        put_result(corpus_key(partner), corpus_parquet(rows), "application/vnd.apache.parquet", encoding="")
+        logger.info(f"Corpus export: {len(rows)} rows -> s3://{RESULTS_BUCKET}/{corpus_key(partner)}")
+    return {partner: len(rows) for partner, rows in partners.items()}
+
+
+class PartnerPartsWriter:
+    """Collects each document's partner index entry, and its corpus row
+    with CORPUS_EXPORT, then writes one part file per partner and kind per
+    flush(). The partners written to are kept in `partners` for
+    compact_partner(). handler() flushes once per invocation,
+    analyze_bucket() every PARTS_FLUSH_DOCS documents and at the end.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = {}  # partner -> {s3_key: index entry}
+        self._corpus = {}  # partner -> {s3_key: corpus row}
+        self.partners = set()
+
+    def add(self, analysis: dict):
+        partner = analysis["s3_key"].split("/")[0]
+        entry = index_entry(analysis)
+        row = flatten_analysis(analysis) if CORPUS_EXPORT else None
+        with self._lock:
+            self._index.setdefault(partner, {})[analysis["s3_key"]] = entry
+            if row is not None:
+                self._corpus.setdefault(partner, {})[analysis["s3_key"]] = row
+
+    def flush(self):
+        with self._lock:
+            for partner, entries in list(self._index.items()):
+                put_result(part_key(partner_index_parts_prefix(partner), ".ndjson"), index_ndjson(entries),
+                           "application/x-ndjson")
+                del self._index[partner]
+                self.partners.add(partner)
+            for partner, rows in list(self._corpus.items()):
+                put_result(part_key(corpus_parts_prefix(partner), ".parquet"), corpus_parquet(list(rows.values())),
+                           "application/vnd.apache.parquet", encoding="")
+                del self._corpus[partner]
+                self.partners.add(partner)
+
+
+def compact_partner(partner: str) -> dict:
+    """Merge a partner's pending parts into its index, corpus file and
+    search database. Returns the number of parts merged into each."""
+    return {
+        "index": compact_parts(partner_index_key(partner), partner_index_parts_prefix(partner),
+                               merge_partner_index, "application/x-ndjson"),
+        "corpus": compact_parts(corpus_key(partner), corpus_parts_prefix(partner), merge_corpus,
+                                "application/vnd.apache.parquet", encoding=""),
+        "search": compact_search_index(partner),
+    }
+
+
+def result_partners() -> list:
+    """Partners with results under RESULTS_PREFIX."""
+    paginator = s3.get_paginator("list_objects_v2")
+    return [
+        prefix["Prefix"][len(RESULTS_PREFIX):].strip("/")
+        for page in paginator.paginate(Bucket=RESULTS_BUCKET, Prefix=RESULTS_PREFIX, Delimiter="/")
+        for prefix in page.get("CommonPrefixes", [])
+        if not prefix["Prefix"][len(RESULTS_PREFIX):].startswith("_")
+    ]
+
+
+# ---------------------------------------------------------------------------
+# Full-text search index
+# ---------------------------------------------------------------------------
+
+# SEARCH_INDEX=1 adds each analyzed document's extracted text to an SQLite
+# FTS5 index, one database per partner under _analysis/_search/partner=<name>/.
+# Like the other partner-wide objects (see PARTS_FLUSH_DOCS), analysis never
+# rewrites a partner's database: SearchIndexWriter uploads each batch of
+# documents as a small delta database under partner=<name>/delta/, and
+# compaction merges the pending deltas into index.sqlite in one rewrite.
+# Searching is then an indexed lookup instead of re-extracting the bucket,
+# and sees documents once they have been compacted:
+#
+#     python handler.py --search 'ФОП Петренко' [partner]
+#
+# unicode61 case-folds Cyrillic but keeps і/ї/й/ґ distinct; apostrophes are
+# part of words (під'їзд), with every apostrophe variant indexed as '.
+# Prefix queries (котельн*) stand in for stemming.
+SEARCH_INDEX = os.environ.get("SEARCH_INDEX", "").lower() not in ("", "0", "off")
+SEARCH_PREFIX = RESULTS_PREFIX + "_search/"
+SEARCH_CACHE_DIR = os.environ.get("SEARCH_CACHE_DIR", os.path.join(tempfile.gettempdir(), "search-index"))
+
+_SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(
+    s3_key UNINDEXED,
+    classification UNINDEXED,
+    text,
+    tokenize = "unicode61 remove_diacritics 0 tokenchars ''''",
+    prefix = '3 5'
+)
+"""
+# Deltas are plain tables: compaction is the only place text is tokenized
+_SEARCH_DELTA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (s3_key TEXT PRIMARY KEY, classification TEXT, text TEXT)
+"""
+_APOSTROPHES = str.maketrans({"’": "'", "ʼ": "'", "`": "'"})
+
+
+def search_index_key(partner: str) -> str:
+    return f"{SEARCH_PREFIX}partner={partner}/index.sqlite"
+
+
+def search_delta_prefix(partner: str) -> str:
+    return f"{SEARCH_PREFIX}partner={partner}/delta/"
+
+
+class SearchIndexWriter:
+    """Collects documents' text into a local delta database per partner and
+    uploads each pending delta once per flush().
+
+    add() costs a local insert; flush() one PUT per partner with new
+    documents, whatever the size of its index. The partners written to are
+    kept in `partners` for compact_search_index(). handler() flushes once
+    per invocation, analyze_bucket() every PARTS_FLUSH_DOCS documents and
+    at the end.
+    """
+
+    def __init__(self):
+        self._dir = tempfile.mkdtemp(prefix="search-index-")
+        self._deltas = {}  # partner -> local delta path
+        self._lock = threading.Lock()
+        self.partners = set()
+
+    def add(self, analysis: dict, text: str):
+        s3_key = analysis["s3_key"]
+        row = (s3_key, analysis["classification"], text.translate(_APOSTROPHES))
+        partner = s3_key.split("/")[0]
+        with self._lock:
+            path = self._deltas.get(partner)
+            if path is None:
+                path = self._deltas[partner] = os.path.join(self._dir, f"{partner}-{time.monotonic_ns()}.sqlite")
+            conn = sqlite3.connect(path)
+            try:
+                conn.execute(_SEARCH_DELTA_SCHEMA)
+                conn.execute("INSERT OR REPLACE INTO documents (s3_key, classification, text) VALUES (?, ?, ?)", row)
+                conn.commit()
+            finally:
+                conn.close()
+
+    def flush(self):
+        with self._lock:
+            for partner, path in list(self._deltas.items()):
+                key = part_key(search_delta_prefix(partner), ".sqlite")
+                put_result(key, Path(path).read_bytes(), "application/vnd.sqlite3")
+                logger.info(f"Search delta: {partner} -> s3://{RESULTS_BUCKET}/{key}")
+                os.unlink(path)
+                del self._deltas[partner]
+                self.partners.add(partner)
+
+    def close(self):
+        """Flush, then remove the local deltas."""
+        try:
+            self.flush()
+        finally:
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+
+def compact_search_index(partner: str) -> int:
+    """Merge a partner's pending deltas into its index, then delete them.
+
+    The index is rewritten once for all of them, with a conditional PUT; if
+    another compaction got there first, the merge is redone on its result.
+    Deltas uploaded after the listing stay for the next run. Returns the
+    number of deltas merged.
+    """
+    keys = list_parts(search_delta_prefix(partner))
+    if not keys:
+        return 0
+
+    index_key = search_index_key(partner)
+    with tempfile.TemporaryDirectory(prefix="search-compact-") as tmp:
+        # Later deltas win for a document that is in several
+        pending = os.path.join(tmp, "pending.sqlite")
+        conn = sqlite3.connect(pending)
+        try:
+            conn.execute(_SEARCH_DELTA_SCHEMA)
+            for key in keys:
+                body, _ = read_result(key)
+                if body is None:
+                    continue  # merged and deleted by a concurrent compaction
+                delta = os.path.join(tmp, "delta.sqlite")
+                Path(delta).write_bytes(body)
+                conn.execute("ATTACH DATABASE ? AS delta", (delta,))
+                conn.execute("INSERT OR REPLACE INTO documents SELECT s3_key, classification, text FROM delta.documents")
+                conn.commit()
+                conn.execute("DETACH DATABASE delta")
+                os.unlink(delta)
+        finally:
+            conn.close()
+
+        path = os.path.join(tmp, "index.sqlite")
+        for _ in range(RESULT_WRITE_RETRIES):
+            body, etag = read_result(index_key)
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            if body:
+                Path(path).write_bytes(body)
+            conn = sqlite3.connect(path)
+            try:
+                conn.execute(_SEARCH_SCHEMA)
+                conn.execute("ATTACH DATABASE ? AS pending", (pending,))
+                conn.execute("DELETE FROM documents WHERE s3_key IN (SELECT s3_key FROM pending.documents)")
+                conn.execute("INSERT INTO documents (s3_key, classification, text) "
+                             "SELECT s3_key, classification, text FROM pending.documents")
+                conn.commit()
+                conn.execute("DETACH DATABASE pending")
+                # Merge segments and drop free pages before the upload
+                conn.execute("INSERT INTO documents(documents) VALUES ('optimize')")
+                conn.commit()
+                conn.execute("VACUUM")
+            finally:
+                conn.close()
+            condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+            try:
+                put_result(index_key, Path(path).read_bytes(), "application/vnd.sqlite3", "", **condition)
+            except s3.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                    raise
+                logger.info(f"{index_key} changed concurrently, merging again")
+                continue
+            break
+        else:
+            raise RuntimeError(f"Could not update {index_key} after {RESULT_WRITE_RETRIES} attempts")
+
+    delete_parts(keys)
+    logger.info(f"Search index: {partner} + {len(keys)} deltas -> s3://{RESULTS_BUCKET}/{index_key}")
+    return len(keys)
+
+
+def fetch_search_index(partner: str, cache_dir: str = SEARCH_CACHE_DIR) -> str | None:
+    """Local copy of a partner's index, downloaded again only when it has
+    changed. Returns its path, or None if the partner has no index."""
+    path = Path(cache_dir) / f"{partner}.sqlite"
+    etag_path = path.with_suffix(".etag")
+    params = {"Bucket": RESULTS_BUCKET, "Key": search_index_key(partner)}
+    if path.exists() and etag_path.exists():
+        params["IfNoneMatch"] = etag_path.read_text()
+    try:
+        response = s3.get_object(**params)
+    except s3.exceptions.NoSuchKey:
+        return None
+    except s3.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("304", "NotModified"):
+            raise
+        return str(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(response["Body"].read())
+    tmp.replace(path)
+    etag_path.write_text(response["ETag"])
+    return str(path)
+
+
+def search_partners() -> list:
+    paginator = s3.get_paginator("list_objects_v2")
+    return [
+        prefix["Prefix"][len(SEARCH_PREFIX):].strip("/").removeprefix("partner=")
+        for page in paginator.paginate(Bucket=RESULTS_BUCKET, Prefix=SEARCH_PREFIX, Delimiter="/")
+        for prefix in page.get("CommonPrefixes", [])
+    ]
+
+
+def search_documents(query: str, partners: list = None, limit: int = 20,
+                     cache_dir: str = SEARCH_CACHE_DIR) -> list:
+    """Best matches for an FTS5 query across partner indexes, by bm25.
+
+    A query that isn't valid FTS5 syntax (stray punctuation such as "м.")
+    is retried with every term quoted, so plain text works too.
+    """
+    query = query.translate(_APOSTROPHES)
+    sql = (
+        "SELECT s3_key, classification, bm25(documents), snippet(documents, 2, '[', ']', '…', 12) "
+        "FROM documents WHERE documents MATCH ? ORDER BY rank LIMIT ?"
+    )
+    hits = []
+    for partner in partners or search_partners():
+        path = fetch_search_index(partner, cache_dir)
+        if path is None:
+            continue
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            try:
+                rows = conn.execute(sql, (query, limit)).fetchall()
+            except sqlite3.OperationalError:
+                quoted = " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+                rows = conn.execute(sql, (quoted, limit)).fetchall()
+        finally:
+            conn.close()
+        hits += [
+            {"s3_key": key, "partner": partner, "classification": doc_type,
+             "score": round(-rank, 3), "snippet": snippet}
+            for key, doc_type, rank, snippet in rows
+        ]
+    hits.sort(key=lambda h: h["score"], reverse=True)
+    return hits[:limit]
+
+
+# ---------------------------------------------------------------------------
+# Near-duplicate index (MinHash + LSH)
+# ---------------------------------------------------------------------------
+
+# Each document's text is reduced to a MinHash signature over word
+# shingles. The signature is cut into LSH bands, and each band hashes to a
+# small bucket object under _analysis/_lsh/. Finding near-duplicates costs
+# one read-modify-write per band, whatever the size of the corpus. Only
+# documents sharing a bucket are compared, by signature agreement (an
+# estimate of shingle Jaccard similarity). With 20 bands of 5 rows, a pair
+# at the 0.7 threshold shares a bucket with probability ~0.97; at 0.8, ~0.9999.
+#
+# A new or changed document costs ~40 extra S3 requests (a GET and a
+# conditional PUT per band, landing in the results bucket), an unchanged one
+# ~20 GETs, so the stage is opt-in: DUPLICATE_INDEX=1. Each document's bucket
+# keys are kept in _lsh/v1/docs/, so a re-analysis with different text also
+# takes it out of the buckets of its previous signature.
+DUPLICATE_INDEX = os.environ.get("DUPLICATE_INDEX", "").lower() not in ("", "0", "off")
+DUPLICATE_THRESHOLD = float(os.environ.get("DUPLICATE_THRESHOLD", 0.7))
+DUPLICATE_PREFIX = RESULTS_PREFIX + "_lsh/v1/"
+SHINGLE_WORDS = 3
+MIN_SHINGLES = 20
+MINHASH_BANDS = 20
+MINHASH_ROWS = 5
+MINHASH_PRIME = (1 << 31) - 1
+MINHASH_CHUNK = 4096
+LSH_WORKERS = 4
+
+_WORD_RE = re.compile(r"\w+")
+
+
+@functools.lru_cache(maxsize=1)
+def _minhash_params():
+    import numpy as np
+
+    rng = np.random.default_rng(20240601)
+    count = MINHASH_BANDS * MINHASH_ROWS
+    a = rng.integers(1, MINHASH_PRIME, size=count, dtype=np.uint64)
+    b = rng.integers(0, MINHASH_PRIME, size=count, dtype=np.uint64)
+    return a[:, None], b[:, None]
+
+
+def minhash_signature(text: str):
+    """MinHash signature (uint32 array) of the text's word shingles, or
+    None if the text is too short to compare meaningfully."""
+    import numpy as np
+
+    words = np.fromiter(
+        (zlib.crc32(w.encode("utf-8")) for w in _WORD_RE.findall(text.lower())), dtype=np.uint64
+    )
+    if len(words) < SHINGLE_WORDS + MIN_SHINGLES - 1:
+        return None
+    # Polynomial hash of each run of SHINGLE_WORDS word hashes (wrapping uint64)
+    count = len(words) - SHINGLE_WORDS + 1
+    shingles = np.zeros(count, dtype=np.uint64)
+    for j in range(SHINGLE_WORDS):
+        shingles = shingles * np.uint64(1000003) + words[j:j + count]
+    shingles = np.unique(shingles % np.uint64(MINHASH_PRIME))
+    if len(shingles) < MIN_SHINGLES:
+        return None
+
+    # h(x) = (a*x + b) mod p per permutation; a, x < 2**31 so a*x fits in uint64
+    a, b = _minhash_params()
+    signature = np.full(len(a), MINHASH_PRIME, dtype=np.uint64)
+    for start in range(0, len(shingles), MINHASH_CHUNK):
+        chunk = shingles[start:start + MINHASH_CHUNK]
+        np.minimum(signature, ((a * chunk + b) % np.uint64(MINHASH_PRIME)).min(axis=1), out=signature)
+    return signature.astype(np.uint32)
+
+
+def signature_similarity(a, b) -> float:
+    return float((a == b).mean())
+
+
+def lsh_bucket_keys(signature) -> list:
+    keys = []
+    for band in range(MINHASH_BANDS):
+        rows = signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]
+        digest = hashlib.blake2b(rows.tobytes(), digest_size=8).hexdigest()
+        keys.append(f"{DUPLICATE_PREFIX}b{band:02d}/{digest}.json")
+    return keys
+
+
+def lsh_registration_key(s3_key: str) -> str:
+    """Object listing the bucket keys a document is currently registered in."""
+    digest = hashlib.blake2b(s3_key.encode("utf-8"), digest_size=16).hexdigest()
+    return f"{DUPLICATE_PREFIX}docs/{digest}.json"
+
+
+def find_duplicate(s3_key: str, text: str) -> dict | None:
+    """Register the document in the LSH index and return its closest earlier
+    near-duplicate as {"s3_key", "similarity"}, or None.
+
+    "Earlier" is by first registration, so of two copies only the later one
+    is flagged, however often either is re-analyzed. An unchanged signature
+    only reads its buckets; a changed one is written to its new buckets and
+    removed from the ones it no longer hashes to.
+    """
+    import numpy as np
+
+    signature = minhash_signature(text)
+    buckets = lsh_bucket_keys(signature) if signature is not None else []
+    registration_key = lsh_registration_key(s3_key)
+    body, _ = read_result(registration_key)
+    previous = json.loads(body)["buckets"] if body else []
+    stale = [key for key in previous if key not in set(buckets)]
+    changed = previous != buckets
+    if signature is None and not stale:
+        return None
+
+    encoded = signature.astype(">u4").tobytes().hex() if signature is not None else None
+    now = datetime.now(timezone.utc).isoformat()
+
+    def register(bucket_key):
+        def upsert(body):
+            entries = json.loads(body) if body else {}
+            others = {k: v for k, v in entries.items() if k != s3_key}
+            seen = entries.get(s3_key, {}).get("seen", now)
+            entries[s3_key] = {"signature": encoded, "seen": seen}
+            return json.dumps(entries).encode("utf-8"), (seen, others)
+
+        return update_result_object(bucket_key, upsert, "application/json")
+
+    def read(bucket_key):
+        body, _ = read_result(bucket_key)
+        entries = json.loads(body) if body else {}
+        seen = entries.get(s3_key, {}).get("seen", now)
+        return seen, {k: v for k, v in entries.items() if k != s3_key}
+
+    def deregister(bucket_key):
+        def drop(body):
+            entries = json.loads(body) if body else {}
+            entries.pop(s3_key, None)
+            return json.dumps(entries).encode("utf-8"), None
+
+        return update_result_object(bucket_key, drop, "application/json")
+
+    candidates = {}
+    first_seen = now
+    with ThreadPoolExecutor(max_workers=LSH_WORKERS) as pool:
+        removed = [pool.submit(deregister, key) for key in stale]
+        for seen, others in pool.map(register if changed else read, buckets):
+            first_seen = min(first_seen, seen)
+            candidates.update(others)
+        for future in removed:
+            future.result()
+    if changed:
+        # Written last: a run that dies midway still finds the old buckets
+        put_result(registration_key, json.dumps({"s3_key": s3_key, "buckets": buckets}).encode("utf-8"),
+                   "application/json")
+
+    best = None
+    for key, entry in candidates.items():
+        if (entry["seen"], key) >= (first_seen, s3_key):
+            continue
+        other = np.frombuffer(bytes.fromhex(entry["signature"]), dtype=">u4").astype(np.uint32)
+        similarity = signature_similarity(signature, other)
+        if similarity >= DUPLICATE_THRESHOLD and (best is None or similarity > best["similarity"]):
+            best = {"s3_key": key, "similarity": round(similarity, 3)}
+    return best
+
+
+# ---------------------------------------------------------------------------
+# Document pipeline
+# ---------------------------------------------------------------------------
+
+SUPPORTED_EXTENSIONS = (".pdf", ".docx") + SPREADSHEET_EXTENSIONS
+
+
+# How much text each analyzer reads. Cost signals and the co-financing check
+# scan everything extracted; with TEXT_SCAN_MAX_PAGES > 0 that is capped to the
+# first N pages (or the text prefixes above, if longer) for everything except
+# cost estimates, which always get a full scan.
+CLASSIFY_TEXT_CHARS = 1000
+PROJECT_INFO_TEXT_CHARS = 5000
+VERIFICATION_TEXT_CHARS = 5000
+TEXT_SCAN_MAX_PAGES = int(os.environ.get("TEXT_SCAN_MAX_PAGES", 0))
+
+# Settings that change analysis output are part of the cache namespace
+if TEXT_SCAN_MAX_PAGES:
+    ANALYZER_VERSION += f"-p{TEXT_SCAN_MAX_PAGES}"
+if OCR_MAX_PAGES:
+    ANALYZER_VERSION += f"-ocr{OCR_MAX_PAGES}-{OCR_LANGUAGES}"
+
+
+def analyze_file(source: str | bytes, ext: str, s3_key: str) -> dict:
+    """Parse a document (file path or bytes) and run the text-only analysis stages.
+
+    Touches no S3 state, so it can run in a worker process during backfills.
+    Stage timings come back in "timings" (empty unless METRICS is set).
+    """
+    timer = StageTimer()
+    with timer.stage("extract"):
+        doc_text = load_document_text(source, ext)
+    try:
+        with timer.stage("extract"):
+            classify_text = doc_text.prefix(CLASSIFY_TEXT_CHARS)
+            project_text = doc_text.prefix(PROJECT_INFO_TEXT_CHARS)
+            doc_text.prefix(VERIFICATION_TEXT_CHARS)
+        with timer.stage("classify"):
+            classification, rule, rule_source = CLASSIFIER.classify(s3_key, classify_text)
+        with timer.stage("project_info"):
+            project_info = extract_project_info(s3_key, project_text)
+        with timer.stage("extract"):
+            if TEXT_SCAN_MAX_PAGES > 0 and classification != "cost_estimate":
+                text = doc_text.first_pages(TEXT_SCAN_MAX_PAGES)
+            else:
+                text = doc_text.full()
+        cost_table = None
+        if classification == "cost_estimate" and ext == ".pdf":
+            with timer.stage("cost_table"):
+                cost_table = extract_cost_table(doc_text.loader.doc)
+        elif classification == "cost_estimate" and ext in SPREADSHEET_EXTENSIONS:
+            # Line items were collected while the sheets were read
+            with timer.stage("cost_table"):
+                cost_table = doc_text.loader.cost_table.result()
+    finally:
+        doc_text.close()
+
+    # Line items give the real estimate total; the regex sum double-counts
+    # subtotals and misses repeated amounts
+    with timer.stage("cost"):
+        if ext in SPREADSHEET_EXTENSIONS:
+            # Taken from the cells while the sheets were read
+            scanned = doc_text.loader.amounts(doc_text.page_starts)
+        else:
+            scanned = scan_currency_amounts(text)
+        cost_signals = extract_cost_signals(text, scanned)
+    cost_signals["total_uah_source"] = "regex"
+    if cost_table is not None:
+        if cost_table["currency"] is None and set(cost_signals["by_currency"]) <= {"UAH"}:
+            # No heading names a currency and nothing in the text is foreign:
+            # an estimate is in hryvnia unless it says otherwise
+            cost_table["total_uah"] = cost_table["total"]
+        if cost_table["total_uah"] is not None:
+            cost_signals["total_uah"] = cost_table["total_uah"]
+            cost_signals["total_uah_source"] = "table"
+        else:
+            # A foreign-currency or unlabelled table can't stand in for hryvnia
+            cost_signals["table_skipped"] = (f"cost table in {cost_table['currency']}" if cost_table["currency"]
+                                             else "cost table currency unknown")
+
+    parsed = {
+        "metadata": doc_text.metadata,
+        "full_text": text,
+        "text_complete": doc_text.complete,
+        "page_starts": doc_text.page_starts,
+    }
+    if ext in SPREADSHEET_EXTENSIONS:
+        parsed["page_count"] = doc_text.page_count  # sheets
+        parsed["pages_extracted"] = doc_text.pages_extracted
+    if ext == ".pdf":
+        parsed["page_count"] = doc_text.page_count
+        parsed["pages_extracted"] = doc_text.pages_extracted
+        parsed["ocr_pages"] = doc_text.loader.ocr_pages
+    return {
+        "parsed": parsed,
+        "classification": classification,
+        "classification_rule": {"pattern": rule, "source": rule_source} if rule else None,
+        "cost_signals": cost_signals,
+        "cost_table": cost_table,
+        "project_info": project_info,
+        "amount_spans": cost_amount_spans(scanned),
+        "timings": timer.ms,
+    }
+
+
+def stages_from_cache(entry: dict, s3_key: str) -> dict | None:
+    """Rebuild analyze_file() output for s3_key from a cached entry.
+
+    Classification and project info depend on the key as well as the text,
+    so they are recomputed; the extracted text and cost signals are reused.
+    """
+    parsed = entry["parsed"]
+    text = parsed.get("full_text", "")
+    classification, rule, rule_source = CLASSIFIER.classify(s3_key, text[:CLASSIFY_TEXT_CHARS])
+    if classification == "cost_estimate" and (
+        not parsed.get("text_complete", True)
+        or (Path(s3_key).suffix.lower() in (".pdf",) + SPREADSHEET_EXTENSIONS and "cost_table" not in entry)
+    ):
+        # Cached under a non-estimate name: page-capped scan, no table pass
+        return None
+    return {
+        "parsed": parsed,
+        "classification": classification,
+        "classification_rule": {"pattern": rule, "source": rule_source} if rule else None,
+        "cost_signals": entry["cost_signals"],
+        "cost_table": entry.get("cost_table"),
+        "project_info": extract_project_info(s3_key, text[:PROJECT_INFO_TEXT_CHARS]),
+        "amount_spans": entry.get("amount_spans"),
+    }
+
+
+# Listings kept per ListingCache, least recently used dropped first. A
+# backfill lists the bucket in key order, so a project folder's documents
+# arrive together and partner roots are hit by every document under them;
+# a few hundred prefixes keep both warm while memory stays flat however
+# many folders the bucket has.
+LISTING_CACHE_PREFIXES = int(os.environ.get("LISTING_CACHE_PREFIXES", 256))
+
+
+class ListingCache:
+    """Prefix listings shared across one invocation or backfill, so each
+    folder is LISTed once while its documents are processed. Sibling types
+    come from the classifier's filename memo.
+
+    Holds at most max_prefixes listings (LRU). Listings follow pagination.
+    Call invalidate() when an object lands after its folder may already
+    have been listed.
+    """
+
+    def __init__(self, max_prefixes: int = LISTING_CACHE_PREFIXES):
+        self._lock = threading.Lock()
+        self._listings = collections.OrderedDict()  # (bucket, prefix, delimiter) -> [key, ...]
+        self._prefix_locks = {}  # only while a prefix is being listed
+        self.max_prefixes = max_prefixes
+        self.list_calls = 0
+
+    def list_keys(self, bucket: str, prefix: str, delimiter: str = "") -> list:
+        cache_key = (bucket, prefix, delimiter)
+        with self._lock:
+            if cache_key in self._listings:
+                self._listings.move_to_end(cache_key)
+                return self._listings[cache_key]
+            prefix_lock = self._prefix_locks.setdefault(cache_key, threading.Lock())
+
+        # Concurrent callers for the same prefix wait for one LIST instead of racing
+        with prefix_lock:
+            with self._lock:
+                if cache_key in self._listings:
+                    return self._listings[cache_key]
+
+            params = {"Bucket": bucket, "Prefix": prefix}
+            if delimiter:
+                params["Delimiter"] = delimiter
+            keys = []
+            for page in s3.get_paginator("list_objects_v2").paginate(**params):
+                self.list_calls += 1
+                keys.extend(obj["Key"] for obj in page.get("Contents", []))
+
+            with self._lock:
+                self._listings[cache_key] = keys
+                while len(self._listings) > self.max_prefixes:
+                    self._listings.popitem(last=False)
+                self._prefix_locks.pop(cache_key, None)
+            return keys
+
+    def doc_type(self, key: str) -> str:
+        return CLASSIFIER.classify_filename(key)[0]
+
+    def invalidate(self, bucket: str, key: str):
+        """Drop cached listings that should contain key but were taken before it landed."""
+        with self._lock:
+            for cache_key in list(self._listings):
+                cached_bucket, prefix, delimiter = cache_key
+                if cached_bucket != bucket or not key.startswith(prefix):
+                    continue
+                if delimiter and delimiter in key[len(prefix):]:
+                    continue
+                if key not in self._listings[cache_key]:
+                    del self._listings[cache_key]
+
+
+def list_project_docs(bucket: str, key: str, listings: ListingCache = None) -> tuple:
+    """Return (sibling_keys, doc_types) for the project folder and partner root."""
+    if listings is None:
+        listings = ListingCache()
+
+    # List sibling docs in same project folder for cross-reference
+    project_prefix = "/".join(key.split("/")[:-1]) + "/"
+    sibling_keys = [
+        k for k in listings.list_keys(bucket, project_prefix)
+        if not k.startswith(RESULTS_PREFIX)
+    ]
+
+    # For verification, we need classifications of all sibling docs
+    # For now, classify by filename only (fast path)
+    all_project_doc_types = [listings.doc_type(k) for k in sibling_keys]
+
+    # Also check parent folder for PV docs (partner-level)
+    partner_prefix = key.split("/")[0] + "/"
+    partner_files = [
+        k for k in listings.list_keys(bucket, partner_prefix, delimiter="/")
+        if k != partner_prefix
+    ]
+    all_project_doc_types += [listings.doc_type(k) for k in partner_files]
+
+    return sibling_keys, all_project_doc_types
+
+
+def process_document(
+    bucket: str,
+    key: str,
+    parse_pool=None,
+    listings: ListingCache = None,
+    result_cache=None,
+    s3_io: S3IO = None,
+    parts: PartnerPartsWriter = None,
+    search_index: SearchIndexWriter = None,
+) -> dict:
+    """Download, analyze and write the analysis JSON for one S3 object.
+
+    If parse_pool (a concurrent.futures executor) is given, parsing and the
+    text-only stages run there instead of in the calling thread. listings
+    shares sibling listings across documents of the same batch. With a
+    result_cache, an object whose content was already analyzed by this
+    ANALYZER_VERSION is not downloaded or parsed: a HEAD and a cache read
+    replace both. Its other requests (listings, result writes, rollups)
+    are unchanged.
+    With s3_io, the fetch comes from its prefetch queue (and its
+    result_cache is used), the sibling listing runs during parsing and the
+    result objects are written concurrently. parts receives the document's
+    partner index entry and corpus row, search_index its text; the caller
+    flushes both.
+    """
+    ext = Path(key).suffix.lower()
+    timer = StageTimer()
+    bytes_read = 0
+
+    listing = None
+    if s3_io is not None:
+        result_cache = s3_io.result_cache
+        with timer.stage("io_wait"):
+            fetched = s3_io.fetch(bucket, key)
+        listing = s3_io.submit(list_project_docs, bucket, key, listings)
+    else:
+        fetched = ingest_document(bucket, key, result_cache)
+    timer.merge(fetched["timings"])
+    stages = fetched["stages"]
+    digest = fetched["digest"]
+    if stages is not None and s3_io is not None:
+        s3_io.release(bucket, key)
+
+    if stages is None:
+        source, tmp_path = fetched["source"], fetched["tmp_path"]
+        bytes_read = len(source) if tmp_path is None else os.path.getsize(tmp_path)
+        try:
+            if parse_pool is not None:
+                stages = parse_pool.submit(analyze_file, source, ext, key).result()
+            else:
+                stages = analyze_file(source, ext, key)
+        finally:
+            if tmp_path:
+                os.unlink(tmp_path)
+            if s3_io is not None:
+                s3_io.release(bucket, key)
+        timer.merge(stages["timings"])
+        if result_cache is not None:
+            entry = {"parsed": stages["parsed"], "cost_signals": stages["cost_signals"],
+                     "amount_spans": stages["amount_spans"]}
+            if stages["classification"] == "cost_estimate" or stages["cost_table"] is not None:
+                entry["cost_table"] = stages["cost_table"]
+            result_cache.put(digest, entry)
+
+    parsed = stages["parsed"]
+    text = parsed.get("full_text", "")
+    classification = stages["classification"]
+    # Converted at the rates in force on the analysis date (the latest in the
+    # table), not the date the document was prepared
+    with timer.stage("fx"):
+        cost_signals = normalize_cost_signals(stages["cost_signals"], datetime.now(timezone.utc).date())
+    project_info = stages["project_info"]
+
+    with timer.stage("list"):
+        if listing is not None:
+            sibling_keys, all_project_doc_types = listing.result()
+        else:
+            sibling_keys, all_project_doc_types = list_project_docs(bucket, key, listings)
+
+    # Run verification
+    with timer.stage("verify"):
+        verification = run_verification(
+            key, parsed, classification, cost_signals, project_info, all_project_doc_types
+        )
+
+    duplicate_of = None
+    if DUPLICATE_INDEX:
+        with timer.stage("duplicates"):
+            duplicate_of = find_duplicate(key, text)
+
+    # Build result (without full_text to keep output manageable)
+    analysis = {
+        "analyzed_at": datetime.now(timezone.utc).isoformat(),
+        "source": f"s3://{bucket}/{key}",
+        "s3_key": key,
+        "file_type": ext.lstrip("."),
+        "classification": classification,
+        "classification_rule": stages["classification_rule"],
+        "project_info": project_info,
+        "page_count": parsed.get("page_count"),
+        "text_length": len(text),
+        "text_complete": parsed["text_complete"],
+        "ocr_pages": parsed.get("ocr_pages", 0),
+        "cost_signals": cost_signals,
+        "cost_table": stages["cost_table"],
+        "verification": verification,
+        "duplicate_of": duplicate_of,
+        "sibling_docs": sibling_keys,
+        "text_preview": text[:2000],
+        "analyzer_version": ANALYZER_VERSION,
+        "content_digest": digest,
+    }
+    base_key = RESULTS_PREFIX + key.rsplit(".", 1)[0]
+    if HIT_INDEX:
+        analysis["hit_index"] = base_key + ".hits.json"
+
+    # Stages up to verification; the writes below are only in the EMF record
+    if "output" in METRICS:
+        analysis["metrics"] = document_metrics(timer, bytes_read, parsed.get("page_count"))
+
+    # Write result to S3
+    result_key = base_key + ".analysis.json"
+    hits = None
+    if HIT_INDEX:
+        with timer.stage("hit_index"):
+            hits = json.dumps(build_hit_index(analysis, parsed, project_info, stages.get("amount_spans")),
+                              ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if s3_io is not None:
+        # Separate objects, so no write has to wait for another
+        writes = [
+            (put_result, result_key, render_analysis(analysis), "application/json"),
+            (update_project_rollup, analysis),
+        ]
+        if hits is not None:
+            writes.append((put_result, analysis["hit_index"], hits, "application/json"))
+        with timer.stage("write"):
+            for future in [s3_io.submit(*write) for write in writes]:
+                future.result()
+    else:
+        with timer.stage("upload"):
+            put_result(result_key, render_analysis(analysis), "application/json")
+            if hits is not None:
+                put_result(analysis["hit_index"], hits, "application/json")
+        with timer.stage("rollup"):
+            update_project_rollup(analysis)
+
+    if parts is not None:
+        with timer.stage("parts"):
+            parts.add(analysis)
+    if search_index is not None:
+        with timer.stage("search_index"):
+            search_index.add(analysis, text)
+
+    if "emf" in METRICS:
+        emit_emf(key, analysis["file_type"], document_metrics(timer, bytes_read, parsed.get("page_count")))
+
+    logger.info(
+        f"Analysis complete: {key} -> {classification} | "
+        f"verification {verification['score']} ({verification['percentage']}%) | "
+        f"{cost_signals['count']} cost signals"
+    )
+    return analysis
+
+
+def summarize_results(results: list) -> dict:
+    return {
+        "documents_processed": len(results),
+        "results": [
+            {
+                "key": r["s3_key"],
+                "classification": r["classification"],
+                "verification_score": r["verification"]["score"],
+                "cost_signals": r["cost_signals"]["count"],
+            }
+            for r in results
+        ],
+    }
+
+
 # ---------------------------------------------------------------------------
 # Lambda handler
 # ---------------------------------------------------------------------------
 
-def handler(event, context):
-    """Process S3 PutObject events."""
-    results = []
+# Records from one invocation processed concurrently
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", 4))
+
+
+def _message_s3_records(body: str) -> list:
+    """S3 records in an SQS message body: an S3 event notification, as is
+    or in an SNS envelope (SNS topic fanned out to the queue)."""
+    message = json.loads(body)
+    if message.get("Type") == "Notification" and "Message" in message:
+        message = json.loads(message["Message"])
+    return list(message.get("Records", []))  # s3:TestEvent has none
+
 
+def event_s3_records(event) -> tuple:
+    """Flatten an S3 event, or an SQS batch of S3 events, into
+    (item_id, s3_record) pairs. item_id is the SQS messageId, or None for
+    records delivered by S3 directly.
+
+    Returns (pairs, unreadable): SQS messages whose body isn't an S3 event
+    are logged and their messageIds returned instead of failing the batch.
+    """
+    pairs = []
+    unreadable = []
     for record in event.get("Records", []):
-        bucket = record["s3"]["bucket"]["name"]
-        key = unquote_plus(record["s3"]["object"]["key"])
+        if record.get("eventSource") == "aws:sqs":
+            try:
+                s3_records = _message_s3_records(record["body"])
+            except (KeyError, TypeError, AttributeError, ValueError):
+                logger.exception(f"Unreadable SQS message {record['messageId']}: {str(record.get('body'))[:500]}")
+                unreadable.append(record["messageId"])
+                continue
+            pairs += [(record["messageId"], s3_record) for s3_record in s3_records]
+        else:
+            pairs.append((None, record))
+    return pairs, unreadable
+
+
+def handler(event, context):
+    """Process S3 PutObject events, delivered directly or batched via SQS.
+
+    Records are processed concurrently and share one sibling-listing cache.
+    A failing record doesn't stop the others: SQS messages with a failed
+    record, or that aren't S3 events at all, are returned in
+    batchItemFailures so only they are retried. For
+    direct S3 events the invocation raises after the batch, so Lambda's
+    async retry picks the failures up.
+    """
+    listings = ListingCache()
+    result_cache = make_result_cache()
+    work = []
+    pairs, unreadable = event_s3_records(event)
+    failures = [(item_id, None) for item_id in unreadable]
+
+    for item_id, record in pairs:
+        try:
+            bucket = record["s3"]["bucket"]["name"]
+            key = unquote_plus(record["s3"]["object"]["key"])
+            size = record["s3"]["object"].get("size")
+        except (KeyError, TypeError, AttributeError):
+            logger.exception(f"Not an S3 event record: {str(record)[:500]}")
+            failures.append((item_id, None))
+            continue
 
         # Skip analysis output files and non-document files
         if key.startswith(RESULTS_PREFIX):
@@ -343,111 +3556,68 @@ def handler(event, context):
             continue
 
         ext = Path(key).suffix.lower()
-        if ext not in (".pdf", ".docx"):
+        if ext not in SUPPORTED_EXTENSIONS:
             logger.info(f"Skipping non-document: {key}")
             continue
 
-        logger.info(f"Processing: s3://{bucket}/{key}")
+        if size is not None and size > MAX_DOCUMENT_BYTES:
+            logger.warning(f"Skipping oversized document ({size} bytes): {key}")
+            continue
 
-        # Download to temp
-        with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
-            tmp_path = tmp.name
-            s3.download_file(bucket, key, tmp_path)
+        logger.info(f"Processing: s3://{bucket}/{key}")
+        listings.invalidate(bucket, key)
+        work.append((item_id, bucket, key, size))
 
+    results = []
+    if work:
+        s3_io = S3IO(result_cache, S3_IO_WORKERS, S3_PREFETCH) if S3_IO_WORKERS > 0 else None
+        if s3_io is not None:
+            s3_io.prefetch((bucket, key, size) for _, bucket, key, size in work)
+        parts = PartnerPartsWriter()
+        search_index = SearchIndexWriter() if SEARCH_INDEX else None
         try:
-            # Extract text
-            if ext == ".pdf":
-                parsed = extract_pdf(tmp_path)
-            else:
-                parsed = extract_docx(tmp_path)
-
-            text = parsed.get("full_text", "")
-
-            # Classify
-            classification = classify_document(key, text)
-
-            # Extract costs
-            cost_signals = extract_cost_signals(text)
-
-            # Extract project info
-            project_info = extract_project_info(key, text)
-
-            # List sibling docs in same project folder for cross-reference
-            project_prefix = "/".join(key.split("/")[:-1]) + "/"
-            sibling_response = s3.list_objects_v2(Bucket=bucket, Prefix=project_prefix)
-            sibling_keys = [
-                obj["Key"] for obj in sibling_response.get("Contents", [])
-                if not obj["Key"].startswith(RESULTS_PREFIX)
-            ]
-
-            # For verification, we need classifications of all sibling docs
-            # For now, classify by filename only (fast path)
-            all_project_doc_types = [classify_document(k, "") for k in sibling_keys]
-
-            # Also check parent folder for PV docs (partner-level)
-            partner_prefix = key.split("/")[0] + "/"
-            partner_response = s3.list_objects_v2(Bucket=bucket, Prefix=partner_prefix, Delimiter="/")
-            partner_files = []
-            for obj in partner_response.get("Contents", []):
-                if obj["Key"] != partner_prefix:
-                    partner_files.append(obj["Key"])
-            all_project_doc_types += [classify_document(k, "") for k in partner_files]
-
-            # Run verification
-            verification = run_verification(
-                key, parsed, classification, cost_signals, project_info, all_project_doc_types
-            )
-
-            # Build result (without full_text to keep output manageable)
-            analysis = {
-                "analyzed_at": datetime.now(timezone.utc).isoformat(),
-                "source": f"s3://{bucket}/{key}",
-                "s3_key": key,
-                "file_type": ext.lstrip("."),
-                "classification": classification,
-                "project_info": project_info,
-                "page_count": parsed.get("page_count"),
-                "text_length": len(text),
-                "cost_signals": cost_signals,
-                "verification": verification,
-                "sibling_docs": sibling_keys,
-                "text_preview": text[:2000],
-            }
-
-            # Write result to S3
-            result_key = RESULTS_PREFIX + key.rsplit(".", 1)[0] + ".analysis.json"
-            s3.put_object(
-                Bucket=RESULTS_BUCKET,
-                Key=result_key,
-                Body=json.dumps(analysis, ensure_ascii=False, indent=2),
-                ContentType="application/json",
-            )
-
-            logger.info(
-                f"Analysis complete: {key} -> {classification} | "
-                f"verification {verification['score']} ({verification['percentage']}%) | "
-                f"{cost_signals['count']} cost signals"
-            )
-            results.append(analysis)
-
+            with ThreadPoolExecutor(max_workers=max(1, min(BATCH_WORKERS, len(work)))) as pool:
+                futures = [
+                    pool.submit(process_document, bucket, key, listings=listings, result_cache=result_cache,
+                                s3_io=s3_io, parts=parts, search_index=search_index)
+                    for _, bucket, key, _ in work
+                ]
+                for (item_id, bucket, key, _), future in zip(work, futures):
+                    try:
+                        results.append(future.result())
+                    except Exception:
+                        logger.exception(f"Analysis failed: s3://{bucket}/{key}")
+                        failures.append((item_id, key))
         finally:
-            os.unlink(tmp_path)
+            if s3_io is not None:
+                s3_io.close()
+        try:
+            try:
+                parts.flush()
+            finally:
+                if search_index is not None:
+                    search_index.close()
+        except Exception:
+            # Retry the whole batch rather than leave documents out of the
+            # partner index, corpus or search
+            logger.exception("Partner part files failed to write")
+            failed_keys = {key for _, key in failures}
+            failures += [(item_id, key) for item_id, _, key, _ in work if key not in failed_keys]
+
+    if any(item_id is None for item_id, _ in failures):
+        raise RuntimeError(
+            f"{len(failures)} of {len(work)} documents failed: {[key for _, key in failures]}"
+        )
+
+    failed_messages = list(dict.fromkeys(item_id for item_id, _ in failures))
+    body = summarize_results(results)
+    body["documents_failed"] = len(failures)
 
     # If invoked directly (not from S3 event), return results
     return {
         "statusCode": 200,
-        "body": json.dumps({
-            "documents_processed": len(results),
-            "results": [
-                {
-                    "key": r["s3_key"],
-                    "classification": r["classification"],
-                    "verification_score": r["verification"]["score"],
-                    "cost_signals": r["cost_signals"]["count"],
-                }
-                for r in results
-            ],
-        }, ensure_ascii=False),
+        "body": json.dumps(body, ensure_ascii=False),
+        "batchItemFailures": [{"itemIdentifier": m} for m in failed_messages],
     }
 
 
@@ -455,36 +3625,258 @@ def handler(event, context):
 # Local/batch mode: analyze all docs in a bucket
 # ---------------------------------------------------------------------------
 
-def analyze_bucket(bucket: str = SOURCE_BUCKET, prefix: str = ""):
-    """Run analysis on all documents in a bucket. For local/batch use."""
+def iter_bucket_documents(bucket: str, prefix: str = ""):
+    """Yield (key, etag, size) for every analyzable document, one listing page at a time."""
     paginator = s3.get_paginator("list_objects_v2")
-    all_results = []
-
     for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
         for obj in page.get("Contents", []):
             key = obj["Key"]
             ext = Path(key).suffix.lower()
-            if ext not in (".pdf", ".docx") or key.startswith(RESULTS_PREFIX):
+            if ext not in SUPPORTED_EXTENSIONS or key.startswith(RESULTS_PREFIX):
+                continue
+            if obj.get("Size", 0) > MAX_DOCUMENT_BYTES:
+                logger.warning(f"Skipping oversized document ({obj['Size']} bytes): {key}")
                 continue
+            yield key, obj["ETag"].strip('"'), obj.get("Size")
 
-            fake_event = {
-                "Records": [{
-                    "s3": {
-                        "bucket": {"name": bucket},
-                        "object": {"key": key},
-                    }
-                }]
-            }
-            result = handler(fake_event, None)
-            all_results.append(json.loads(result["body"]))
 
-    return all_results
+class BackfillManifest:
+    """Checkpoint of documents a backfill has finished: one NDJSON line of
+    {"key", "etag", "analyzer_version"} appended per document.
+
+    Entries written by another ANALYZER_VERSION are ignored on load, so a
+    code change re-runs everything; a changed ETag re-runs that object.
+    Appends are flushed per line, so a killed run loses at most the
+    documents that were in flight.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._done = {}  # key -> etag
+        self._lock = threading.Lock()
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line from a killed run
+                    if entry.get("analyzer_version") == ANALYZER_VERSION:
+                        self._done[entry["key"]] = entry["etag"]
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def __len__(self) -> int:
+        return len(self._done)
+
+    def done(self, key: str, etag: str) -> bool:
+        return self._done.get(key) == etag
+
+    def record(self, key: str, etag: str):
+        line = json.dumps({"key": key, "etag": etag, "analyzer_version": ANALYZER_VERSION}, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            self._done[key] = etag
+
+    def close(self):
+        self._file.close()
+
+
+def analyze_bucket(
+    bucket: str = SOURCE_BUCKET,
+    prefix: str = "",
+    workers: int = 1,
+    parse_workers: int = 0,
+    progress_every: int = 25,
+    output=None,
+    manifest: BackfillManifest = None,
+):
+    """Run analysis on all documents in a bucket. For local/batch use.
+
+    workers is the number of documents in flight at once (S3 download,
+    sibling listing and upload run on these threads). parse_workers > 0
+    moves PDF/DOCX parsing and the text stages into a process pool of that
+    size. The defaults reproduce the original serial behaviour.
+
+    The bucket is listed page by page and only a few documents per worker
+    are queued at a time. With output (a text file), each document's
+    handler-style body is written to it as one NDJSON line as soon as it
+    finishes, nothing is kept in memory and the returned list is empty.
+    Otherwise the bodies are returned in listing order. With a manifest,
+    documents it lists with the same ETag are skipped and finished ones are
+    recorded after their output line and after the part files holding
+    them are uploaded, so an interrupted run resumes where it stopped.
+    Failed documents are logged and left out. The partners touched are
+    compacted at the end (see compact_partner()).
+    """
+    logger.info(f"Backfill: s3://{bucket}/{prefix} "
+                f"(workers={workers}, parse_workers={parse_workers}, "
+                f"{len(manifest) if manifest is not None else 0} already in manifest)")
+
+    results = {}
+    failed = []
+    done = 0
+    skipped = 0
+    lock = threading.Lock()
+    started = time.monotonic()
+
+    def report():
+        elapsed = time.monotonic() - started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        logger.info(f"Backfill progress: {done} done, {skipped} unchanged, {len(failed)} failed, "
+                    f"{elapsed:.1f}s elapsed, {rate:.2f} docs/s")
+
+    parse_pool = None
+    if parse_workers > 0:
+        # Forking this process, which already runs S3 client and I/O
+        # threads, can hand a worker a lock held by a thread that isn't
+        # there; forkserver children start from a single-threaded server
+        parse_pool = ProcessPoolExecutor(max_workers=parse_workers,
+                                         mp_context=multiprocessing.get_context("forkserver"))
+    listings = ListingCache()
+    result_cache = make_result_cache()
+    s3_io = S3IO(result_cache, S3_IO_WORKERS, S3_PREFETCH) if S3_IO_WORKERS > 0 else None
+    parts = PartnerPartsWriter()
+    search_index = SearchIndexWriter() if SEARCH_INDEX else None
+    # Documents go into the manifest only once the part files holding them
+    # have been uploaded
+    unflushed = []
+    # Bounds queued documents, so memory doesn't grow with the bucket
+    slots = threading.BoundedSemaphore(max(1, workers) * 2)
+
+    def checkpoint(key=None, etag=None, flush=False):
+        finished = [(key, etag)] if key is not None else []
+        with lock:
+            unflushed.extend(finished)
+            if not flush and len(unflushed) < PARTS_FLUSH_DOCS:
+                return
+            finished = unflushed[:]
+            del unflushed[:]
+        parts.flush()
+        if search_index is not None:
+            search_index.flush()
+        if manifest is not None:
+            for finished_key, finished_etag in finished:
+                manifest.record(finished_key, finished_etag)
+
+    def run(index, key, etag):
+        nonlocal done
+        try:
+            analysis = process_document(
+                bucket, key, parse_pool=parse_pool, listings=listings, result_cache=result_cache,
+                s3_io=s3_io, parts=parts, search_index=search_index,
+            )
+            body = summarize_results([analysis])
+            if output is not None:
+                line = json.dumps(body, ensure_ascii=False)
+                with lock:
+                    output.write(line + "\n")
+                    output.flush()
+            else:
+                results[index] = body
+            checkpoint(key, etag)
+        except Exception:
+            logger.exception(f"Backfill failed: {key}")
+            with lock:
+                failed.append(key)
+        with lock:
+            done += 1
+            if done % progress_every == 0:
+                report()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            for index, (key, etag, size) in enumerate(iter_bucket_documents(bucket, prefix)):
+                if manifest is not None and manifest.done(key, etag):
+                    skipped += 1
+                    continue
+                slots.acquire()
+                if s3_io is not None:
+                    s3_io.prefetch([(bucket, key, size)])
+                pool.submit(run, index, key, etag).add_done_callback(lambda _: slots.release())
+        checkpoint(flush=True)
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+        if s3_io is not None:
+            s3_io.close()
+        if search_index is not None:
+            search_index.close()
+    touched = parts.partners | (search_index.partners if search_index is not None else set())
+    for partner in sorted(touched):
+        compact_partner(partner)
+
+    report()
+    logger.info(f"Backfill listings: {listings.list_calls} LIST requests for {done} documents")
+    if failed:
+        logger.warning(f"Backfill finished with {len(failed)} failures: {failed}")
+    return [results[i] for i in sorted(results)]
 
 
 if __name__ == "__main__":
-    import sys
-    bucket = sys.argv[1] if len(sys.argv) > 1 else SOURCE_BUCKET
-    prefix = sys.argv[2] if len(sys.argv) > 2 else ""
-    print(f"Analyzing all documents in s3://{bucket}/{prefix}")
-    results = analyze_bucket(bucket, prefix)
-    print(json.dumps(results, ensure_ascii=False, indent=2))
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Analyze all documents in a bucket")
+    parser.add_argument("bucket", nargs="?", default=SOURCE_BUCKET)
+    parser.add_argument("prefix", nargs="?", default="")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="documents processed concurrently (S3 I/O threads)")
+    parser.add_argument("--parse-workers", type=int, default=0,
+                        help="process pool size for PDF/DOCX parsing (0 = parse in-thread)")
+    parser.add_argument("--export-corpus", action="store_true",
+                        help="rebuild the Parquet corpus from stored analyses instead of analyzing")
+    parser.add_argument("--search", metavar="QUERY",
+                        help="query the full-text index (prefix = partner) instead of analyzing")
+    parser.add_argument("--limit", type=int, default=20, help="number of --search results")
+    parser.add_argument("--compact", action="store_true",
+                        help="merge pending part files into the partner indexes, corpus and search "
+                             "databases (prefix = partner) instead of analyzing")
+    parser.add_argument("--prune-cache", action="store_true",
+                        help="delete result cache entries of other analyzer versions "
+                             f"idle for RESULT_CACHE_RETENTION_DAYS ({RESULT_CACHE_RETENTION_DAYS})")
+    parser.add_argument("--output",
+                        help="append one NDJSON result line per document here instead of printing JSON")
+    parser.add_argument("--manifest",
+                        help="checkpoint of finished documents; re-runs skip them "
+                             "(default with --output: <output>.manifest)")
+    args = parser.parse_args()
+
+    if args.export_corpus:
+        print(json.dumps(export_corpus(args.prefix), indent=2))
+        raise SystemExit
+
+    if args.prune_cache:
+        cache = make_result_cache()
+        print(f"Pruned {cache.prune() if cache is not None else 0} cache entries")
+        raise SystemExit
+
+    if args.compact:
+        partners = [args.prefix.split("/")[0]] if args.prefix else result_partners()
+        print(json.dumps({partner: compact_partner(partner) for partner in partners}, indent=2))
+        raise SystemExit
+
+    if args.search:
+        started = time.perf_counter()
+        partners = [args.prefix.split("/")[0]] if args.prefix else None
+        hits = search_documents(args.search, partners, args.limit)
+        for hit in hits:
+            print(f"{hit['score']:>8.2f}  {hit['s3_key']} ({hit['classification']})\n          {hit['snippet']}")
+        print(f"{len(hits)} documents in {(time.perf_counter() - started) * 1000:.0f} ms")
+        raise SystemExit
+
+    print(f"Analyzing all documents in s3://{args.bucket}/{args.prefix}")
+    manifest_path = args.manifest or (args.output + ".manifest" if args.output else None)
+    manifest = BackfillManifest(manifest_path) if manifest_path else None
+    try:
+        if args.output:
+            with open(args.output, "a", encoding="utf-8") as output:
+                analyze_bucket(args.bucket, args.prefix, args.workers, args.parse_workers,
+                               output=output, manifest=manifest)
+        else:
+            results = analyze_bucket(args.bucket, args.prefix, args.workers, args.parse_workers,
+                                     manifest=manifest)
+            print(json.dumps(results, ensure_ascii=False, indent=2))
+    finally:
+        if manifest is not None:
+            manifest.close()
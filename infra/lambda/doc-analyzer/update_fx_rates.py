@@ -0,0 +1,60 @@
+"""
+Refresh nbu_rates.csv, the FX table the analyzer converts amounts with.
+
+Downloads official daily NBU rates for the currencies the analyzer extracts
+and writes date,currency,rate (UAH per unit, ISO dates). deploy.sh runs it
+on every deploy and stops if it fails and no earlier nbu_rates.csv exists;
+the handler itself never touches the network for rates.
+
+    python update_fx_rates.py [--start 2022-01-01] [--end today]
+"""
+import argparse
+import csv
+import json
+import urllib.request
+from datetime import date, datetime
+from pathlib import Path
+
+NBU_URL = (
+    "https://bank.gov.ua/NBU_Exchange/exchange_site"
+    "?start={start}&end={end}&valcode={currency}&sort=exchangedate&order=asc&json"
+)
+CURRENCIES = ("USD", "EUR")
+OUTPUT = Path(__file__).with_name("nbu_rates.csv")
+
+
+def fetch(currency: str, start: date, end: date) -> list:
+    url = NBU_URL.format(start=start.strftime("%Y%m%d"), end=end.strftime("%Y%m%d"), currency=currency.lower())
+    with urllib.request.urlopen(url, timeout=60) as response:
+        records = json.load(response)
+    rows = []
+    for record in records:
+        day = datetime.strptime(record["exchangedate"], "%d.%m.%Y").date()
+        rate = record.get("rate_per_unit") or record["rate"] / record.get("units", 1)
+        rows.append((day.isoformat(), currency, rate))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--start", type=date.fromisoformat, default=date(2022, 1, 1))
+    parser.add_argument("--end", type=date.fromisoformat, default=date.today())
+    parser.add_argument("--output", type=Path, default=OUTPUT)
+    args = parser.parse_args()
+
+    rows = []
+    for currency in CURRENCIES:
+        fetched = fetch(currency, args.start, args.end)
+        print(f"{currency}: {len(fetched)} daily rates")
+        rows.extend(fetched)
+    rows.sort()
+
+    with open(args.output, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["date", "currency", "rate"])
+        writer.writerows(rows)
+    print(f"Wrote {len(rows)} rates to {args.output}")
+
+
+if __name__ == "__main__":
+    main()